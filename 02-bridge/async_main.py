@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""Asyncio MQTT to InfluxDB Bridge
+
+Same topic rules, line protocol encoding and disk spool as `main.py`, but on
+a single event loop and without threads: an async MQTT client receives the
+messages, and batches are written over one pooled, keep-alive aiohttp
+session, with up to `INFLUXDB_MAX_IN_FLIGHT` writes in flight at once.
+
+Configuration is shared with `main.py`.
+
+"""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+from asyncio_mqtt import Client, MqttError
+
+import main as bridge
+from batch_writer import RejectedBatch, is_rejection
+from filters import SeriesFilter
+from json_ingest import JsonIngest
+from line_protocol import LineProtocolEncoder
+from spool import Spool, read_batches
+import topic_router
+
+INFLUXDB_MAX_IN_FLIGHT = 4  # concurrent batch writes
+INFLUXDB_MAX_PENDING = 16  # batches waiting for a write slot before MQTT reads pause
+MQTT_RECONNECT_INTERVAL = 5  # seconds
+SPOOL_RETRY_INTERVAL = 10  # seconds
+SCHEMA_LOAD_TIMEOUT = 30  # seconds to wait for the JSON field types at startup
+
+log = logging.getLogger(__name__)
+
+
+class InfluxDBWriter:
+    def __init__(self, session, max_in_flight):
+        self._session = session
+        self._url = f'http://{bridge.INFLUXDB_ADDRESS}:8086'
+        self._auth = aiohttp.BasicAuth(bridge.INFLUXDB_USER, bridge.INFLUXDB_PASSWORD)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def init_database(self):
+        # CREATE DATABASE is a no-op when the database already exists
+        params = {'q': f'CREATE DATABASE "{bridge.INFLUXDB_DATABASE}"'}
+        async with self._session.post(f'{self._url}/query', params=params, auth=self._auth) as resp:
+            resp.raise_for_status()
+
+    async def load_field_types(self):
+        """`{measurement: {field: type}}` for every measurement already in the database."""
+        params = {'db': bridge.INFLUXDB_DATABASE, 'q': 'SHOW FIELD KEYS'}
+        timeout = aiohttp.ClientTimeout(total=SCHEMA_LOAD_TIMEOUT)
+        async with self._session.get(f'{self._url}/query', params=params, auth=self._auth, timeout=timeout) as resp:
+            resp.raise_for_status()
+            response = await resp.json()
+        schemas = {}
+        for result in response.get('results', []):
+            for series in result.get('series', []):
+                schemas[series['name']] = {field: field_type for field, field_type in series['values']}
+        return schemas
+
+    async def write(self, body):
+        params = {'db': bridge.INFLUXDB_DATABASE, 'precision': 'n'}
+        async with self._in_flight:
+            async with self._session.post(f'{self._url}/write', params=params, data=body, auth=self._auth) as resp:
+                if is_rejection(resp.status):
+                    raise RejectedBatch(f'{resp.status}: {await resp.text()}')
+                if resp.status != 204:
+                    raise RuntimeError(f'influxdb write failed with {resp.status}: {await resp.text()}')
+
+
+class AsyncBatchWriter:
+    """Event loop counterpart of `batch_writer.BatchWriter`."""
+
+    def __init__(self, writer, spool, batch_size, flush_interval, max_pending):
+        self._writer = writer
+        self._spool = spool
+        self._encoder = LineProtocolEncoder()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._buffer = bytearray()
+        self._count = 0
+        self._oldest_point_time = None
+        self._pending = set()
+
+    def add(self, sensor_data, timestamp):
+        if not self._count:
+            self._oldest_point_time = time.monotonic()
+        self._count += self._encoder.encode_into(self._buffer, sensor_data, timestamp)
+        if self._count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Start writing everything buffered so far."""
+        if not self._count:
+            return
+        task = asyncio.ensure_future(self._write(self._count, bytes(self._buffer)))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        self._buffer.clear()
+        self._count = 0
+        self._oldest_point_time = None
+
+    async def wait_for_capacity(self):
+        """Pause the caller while too many batches are waiting to be written."""
+        while len(self._pending) >= self.max_pending:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+
+    async def run_flusher(self):
+        while True:
+            delay = self.flush_interval
+            if self._count:
+                delay = self._oldest_point_time + self.flush_interval - time.monotonic()
+                if delay <= 0:
+                    self.flush()
+                    delay = self.flush_interval
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        self.flush()
+        if self._pending:
+            await asyncio.wait(self._pending)
+
+    async def _write(self, count, body):
+        try:
+            await self._writer.write(body)
+        except RejectedBatch as e:
+            log.warning(f'influxdb rejected {count} points, dropping them: {e}')
+        except Exception as e:
+            log.warning(f'failed to write {count} points to influxdb: {e!r}')
+            try:
+                self._spool.append(body)
+            except Exception as e:
+                log.error(f'lost {count} points that failed to write and could not be spooled: {e!r}')
+
+
+async def replay_spool(spool, writer):
+    """Async counterpart of `spool.SpoolReplayer`."""
+    while True:
+        path = None
+        try:
+            spool.sync()
+            path = spool.take_oldest()
+            if path is None:
+                await asyncio.sleep(SPOOL_RETRY_INTERVAL)
+                continue
+            for count, body in read_batches(path, bridge.INFLUXDB_BATCH_SIZE):
+                started = time.monotonic()
+                try:
+                    await writer.write(body)
+                except RejectedBatch as e:
+                    log.warning(f'influxdb rejected {count} points from {path}, dropping them: {e}')
+                # stay under the configured rate so live writes keep their share of InfluxDB
+                await asyncio.sleep(max(0, count / bridge.SPOOL_REPLAY_RATE - (time.monotonic() - started)))
+            spool.remove(path)
+            log.info(f'replayed spool segment {path}, {len(spool)} left')
+        except Exception as e:
+            log.warning(f'spool replay of {path} failed, retrying in {SPOOL_RETRY_INTERVAL}s: {e!r}')
+            await asyncio.sleep(SPOOL_RETRY_INTERVAL)
+
+
+async def flush_filter_windows(series_filter):
+    while True:
+        await asyncio.sleep(series_filter.flush_interval)
+        series_filter.flush_expired()
+
+
+def _handle_message(msg, batch_writer, series_filter):
+    receive_time = time.time_ns()
+    route = bridge.router.route(msg.topic)
+    if route is None or route.kind == topic_router.IGNORE:
+        return
+    payload, timestamp = bridge._split_sample_time(route, msg.payload.decode('utf-8'), receive_time)
+    if payload is None:
+        return
+    sensor_data = bridge._parse_mqtt_message(route, payload)
+    if series_filter is not None:
+        series_filter.process(sensor_data, timestamp)
+    else:
+        batch_writer.add(sensor_data, timestamp)
+
+
+async def consume_messages(batch_writer, series_filter):
+    subscriptions = [(subscription, 0) for subscription in bridge.router.subscriptions]
+    while True:
+        try:
+            async with Client(
+                bridge.MQTT_ADDRESS,
+                1883,
+                username=bridge.MQTT_USER,
+                password=bridge.MQTT_PASSWORD,
+                client_id=bridge.MQTT_CLIENT_ID,
+            ) as client:
+                async with client.unfiltered_messages() as messages:
+                    await client.subscribe(subscriptions)
+                    log.info('Connected')
+                    async for msg in messages:
+                        try:
+                            _handle_message(msg, batch_writer, series_filter)
+                        except Exception as e:
+                            # UnicodeDecodeError included; one bad message must not end ingestion
+                            log.warning(f'failed to handle message on {msg.topic}: {e!r}')
+                            continue
+                        await batch_writer.wait_for_capacity()
+        except MqttError as e:
+            log.warning(f'MQTT connection lost ({e}), reconnecting in {MQTT_RECONNECT_INTERVAL}s')
+            await asyncio.sleep(MQTT_RECONNECT_INTERVAL)
+
+
+async def run():
+    spool = Spool(bridge.SPOOL_DIRECTORY, bridge.SPOOL_SEGMENT_SIZE, bridge.SPOOL_FSYNC_INTERVAL)
+    connector = aiohttp.TCPConnector(limit=INFLUXDB_MAX_IN_FLIGHT)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        writer = InfluxDBWriter(session, INFLUXDB_MAX_IN_FLIGHT)
+        await writer.init_database()
+        # the field types are loaded once here: main's lazy loader is a blocking query that would stall the loop
+        bridge.json_ingest = JsonIngest()
+        try:
+            bridge.json_ingest.add_schemas(await writer.load_field_types())
+        except Exception as e:
+            log.warning(f'could not load the JSON field types, learning them from the data: {e!r}')
+        batch_writer = AsyncBatchWriter(
+            writer,
+            spool,
+            bridge.INFLUXDB_BATCH_SIZE,
+            bridge.INFLUXDB_FLUSH_INTERVAL,
+            INFLUXDB_MAX_PENDING,
+        )
+        background = [
+            asyncio.ensure_future(batch_writer.run_flusher()),
+            asyncio.ensure_future(replay_spool(spool, writer)),
+        ]
+        series_filter = None
+        if bridge.FILTER_RULES:
+            series_filter = SeriesFilter(bridge.FILTER_RULES, batch_writer.add)
+            background.append(asyncio.ensure_future(flush_filter_windows(series_filter)))
+        try:
+            await consume_messages(batch_writer, series_filter)
+        finally:
+            for task in background:
+                task.cancel()
+            await batch_writer.close()
+            spool.close()
+
+
+if __name__ == '__main__':
+    bridge.configure_logging()
+    log.info('MQTT to InfluxDB bridge (asyncio)')
+    asyncio.run(run())
@@ -0,0 +1,159 @@
+"""Batched InfluxDB writer
+
+Encodes points as line protocol into one in-memory buffer and writes them to
+InfluxDB in bulk, as soon as either `batch_size` points are buffered or the
+oldest buffered point is `flush_interval` seconds old. Writes happen on
+background threads, so the caller (e.g. the paho network thread) never waits
+on an HTTP round-trip. With more than one worker, several batches can be in
+flight at once. Batches that fail to write are passed to `on_failure` (e.g.
+to spool them to disk) instead of being lost, unless InfluxDB rejected the
+batch itself (`RejectedBatch`): retrying that cannot succeed, so it is
+logged and dropped. Every write attempt is reported to `on_write` for
+instrumentation. An exception from either callback is logged and counted in
+`callback_errors`; it never stops a writer thread.
+
+"""
+
+import logging
+import threading
+import time
+
+# 4xx responses that say nothing about the batch itself: credentials, a missing
+# database, a timeout or rate limiting can all go away on their own
+RETRYABLE_CLIENT_ERRORS = (401, 403, 404, 408, 429)
+
+log = logging.getLogger(__name__)
+
+
+class RejectedBatch(Exception):
+    """InfluxDB refused the batch (e.g. a parse error or a field type conflict), so it must not be retried."""
+
+
+def is_rejection(status_code):
+    """Whether an InfluxDB write response with this status means the batch should be dropped."""
+    return 400 <= status_code < 500 and status_code not in RETRYABLE_CLIENT_ERRORS
+
+
+class BatchWriter:
+    def __init__(self, write_lines, encode, batch_size=5000, flush_interval=1.0, workers=1,
+                 on_failure=None, on_write=None):
+        """
+        `encode(buffer, *args)` appends the line protocol for one `add(*args)` call
+        to the bytearray `buffer` and returns how many lines it wrote.
+        `write_lines` and `on_failure` are called with the bytes of one batch of
+        at most `batch_size` lines; `write_lines` raises `RejectedBatch` for a
+        batch that must not be retried.
+        `on_write(line_count, seconds, succeeded)` is called after every write attempt.
+        """
+        self._write_lines = write_lines
+        self._encode = encode
+        self._on_failure = on_failure
+        self._on_write = on_write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.callback_errors = 0
+        self._buffer = bytearray()
+        self._count = 0
+        # buffer offsets where each complete batch of `batch_size` lines ends
+        self._batch_ends = []
+        self._oldest_point_time = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'influxdb-batch-writer-{i}', daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Flush everything still buffered and stop the background threads."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def add(self, *args):
+        with self._cond:
+            if not self._count:
+                self._oldest_point_time = time.monotonic()
+            written = self._encode(self._buffer, *args)
+            if written:
+                self._count += written
+                if self._count >= (len(self._batch_ends) + 1) * self.batch_size:
+                    self._batch_ends.append(len(self._buffer))
+                    self._cond.notify()
+
+    def _take_batch(self):
+        """Remove and return `(line_count, bytes)` for the next batch, or None if empty."""
+        if not self._count:
+            return None
+        if self._batch_ends:
+            end = self._batch_ends.pop(0)
+            count = self.batch_size
+            self._batch_ends = [offset - end for offset in self._batch_ends]
+        else:
+            end = len(self._buffer)
+            count = self._count
+        body = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._count -= count
+        self._oldest_point_time = time.monotonic() if self._count else None
+        return count, body
+
+    def _wait_for_batch(self):
+        """Block until a batch is due, then return it (or None once stopped and empty)."""
+        with self._cond:
+            while not self._stopped:
+                if self._batch_ends:
+                    break
+                if self._count:
+                    timeout = self._oldest_point_time + self.flush_interval - time.monotonic()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
+            return self._take_batch()
+
+    def _write(self, count, body):
+        started = time.perf_counter()
+        retry = False
+        try:
+            self._write_lines(body)
+        except RejectedBatch as e:
+            log.warning(f'influxdb rejected {count} points, dropping them: {e}')
+            succeeded = False
+        except Exception as e:
+            log.warning(f'failed to write {count} points to influxdb: {e!r}')
+            succeeded = False
+            retry = True
+        else:
+            succeeded = True
+        if self._on_write is not None:
+            self._call(self._on_write, count, time.perf_counter() - started, succeeded)
+        if retry and self._on_failure is not None:
+            if not self._call(self._on_failure, body):
+                log.error(f'lost {count} points that failed to write and could not be spooled')
+
+    def _call(self, callback, *args):
+        """Call `callback`, logging and counting instead of raising; returns whether it succeeded."""
+        try:
+            callback(*args)
+        except Exception as e:
+            log.warning(f'batch writer callback {callback.__name__} failed: {e!r}')
+            with self._cond:
+                self.callback_errors += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            batch = self._wait_for_batch()
+            if batch is None:
+                return
+            self._write(*batch)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""Load generator: how many messages per second the bridge sustains
+
+Generates `home/<sensor>/<measurement>` traffic from `--sensors` sensors with
+a mix of numeric, string and JSON payloads, and feeds it to the bridge, either
+straight into `main.on_message` or, with `--broker`, through a real MQTT
+broker to a bridge subscribed to it. The bridge writes to an in-process
+stand-in for the InfluxDB HTTP API, which counts write requests, points and
+bytes and records, for a sample of the points, how long after `on_message`
+stamped them they arrived.
+
+Reports the offered and sustained rates, p50/p99 latency from receive to
+InfluxDB (this includes the time a point waits for its batch, up to
+`INFLUXDB_FLUSH_INTERVAL`) and peak memory.
+
+    $ python3 bench_bridge.py --sensors 100 --rate 0 --duration 10
+    $ python3 bench_bridge.py --rate 20000 --mix numeric=8,string=1,json=1 --inline
+    $ python3 bench_bridge.py --broker localhost --rate 5000
+
+"""
+
+import argparse
+import http.server
+import json
+import resource
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from influxdb import InfluxDBClient
+
+from bench_json_ingest import SYSTEM_INFO
+import main as bridge
+
+LATENCY_SAMPLE = 16  # record the latency of one in this many points
+DRAIN_TIMEOUT = 30  # seconds to wait for the last points once generation stops
+
+
+class FakeInfluxDB:
+    """Accepts `/write` and `/query` like InfluxDB 1.x and counts what it is sent."""
+
+    def __init__(self):
+        self.requests = 0
+        self.points = 0
+        self.bytes = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='fake-influxdb', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _record(self, body):
+        received = time.time_ns()
+        lines = body.split(b'\n')
+        if lines and not lines[-1]:
+            lines.pop()
+        latencies = [(received - int(line.rsplit(b' ', 1)[1])) / 1e9 for line in lines[::LATENCY_SAMPLE]]
+        with self._lock:
+            self.requests += 1
+            self.points += len(lines)
+            self.bytes += len(body)
+            self.latencies.extend(latencies)
+
+    def _handler(self):
+        influxdb = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # keep-alive, like the real server, so the client's connection pool is exercised
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.startswith('/write'):
+                    influxdb._record(body)
+                    self._respond(204, b'')
+                else:
+                    self._query()
+
+            def do_GET(self):
+                self._query()
+
+            def _query(self):
+                # CREATE DATABASE, SHOW DATABASES and SHOW FIELD KEYS all get an empty result
+                self._respond(200, json.dumps({'results': [{'statement_id': 0}]}).encode())
+
+            def _respond(self, status, body):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def parse_mix(mix):
+    """`numeric=8,string=1,json=1` -> `{'numeric': 8.0, ...}`"""
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in ('numeric', 'string', 'json'):
+            raise argparse.ArgumentTypeError(f'unknown payload kind {kind!r}')
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def sample_messages(sensors, mix, variants=4):
+    """`(topic, payload)` pairs, round robin over the sensors, each sensor publishing one kind of payload."""
+    total = sum(mix.values())
+    kinds = []
+    for kind, weight in mix.items():
+        kinds += [kind] * round(sensors * weight / total)
+    kinds = (kinds + ['numeric'] * sensors)[:sensors]
+
+    messages = []
+    for variant in range(variants):
+        for sensor, kind in enumerate(kinds):
+            if kind == 'numeric':
+                messages.append((f'home/sensor{sensor}/temperature', f'{20 + variant * 0.25 + sensor % 10:.2f}'))
+            elif kind == 'string':
+                messages.append((f'home/sensor{sensor}/state', 'open' if variant % 2 else 'closed'))
+            else:
+                messages.append((f'home/sensor{sensor}/system_info', SYSTEM_INFO))
+    return [(topic, payload.encode()) for topic, payload in messages]
+
+
+def generate(publish, messages, rate, duration):
+    """Call `publish(message)` at `rate` messages/s (0 for as fast as possible) for `duration` seconds."""
+    sent = 0
+    started = time.perf_counter()
+    deadline = started + duration
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        target = int((now - started) * rate) if rate else sent + 1000
+        while sent < target:
+            publish(messages[sent % len(messages)])
+            sent += 1
+        if rate:
+            time.sleep(0.001)
+    return sent, time.perf_counter() - started
+
+
+def run_direct(messages, args):
+    pool = []
+    for topic, payload in messages:
+        msg = mqtt.MQTTMessage(topic=topic.encode())
+        msg.payload = payload
+        pool.append(msg)
+    stop = bridge.start(tempfile.mkdtemp(prefix='bench-spool-'), tempfile.mktemp(prefix='bench-spill-'))
+    try:
+        sent, elapsed = generate(lambda msg: bridge.on_message(None, None, msg), pool, args.rate, args.duration)
+        return sent, elapsed, stop
+    except BaseException:
+        stop()
+        raise
+
+
+def run_broker(messages, args):
+    bridge.MQTT_ADDRESS = args.broker
+    threading.Thread(
+        target=bridge.main,
+        kwargs={
+            'client_id': 'bench-bridge',
+            'spool_directory': tempfile.mkdtemp(prefix='bench-spool-'),
+            'spill_path': tempfile.mktemp(prefix='bench-spill-'),
+            'metrics_port': None,
+        },
+        name='bridge',
+        daemon=True,
+    ).start()
+
+    publisher = mqtt.Client('bench-publisher')
+    publisher.username_pw_set(bridge.MQTT_USER, bridge.MQTT_PASSWORD)
+    publisher.connect(args.broker, 1883)
+    publisher.loop_start()
+    # give the bridge time to connect and subscribe
+    time.sleep(2)
+    try:
+        sent, elapsed = generate(lambda message: publisher.publish(*message), messages, args.rate, args.duration)
+    finally:
+        publisher.loop_stop()
+        publisher.disconnect()
+    return sent, elapsed, None
+
+
+def wait_for_points(influxdb, expected):
+    """Wait until `expected` points arrived, or no new ones did for a few flush intervals."""
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    last_points, last_change = -1, time.monotonic()
+    while influxdb.points < expected() and time.monotonic() < deadline:
+        if influxdb.points != last_points:
+            last_points, last_change = influxdb.points, time.monotonic()
+        elif time.monotonic() - last_change > 3 * bridge.INFLUXDB_FLUSH_INTERVAL:
+            break
+        time.sleep(0.05)
+    return time.monotonic()
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sensors', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0, help='messages/s to offer, 0 for as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--mix', type=parse_mix, default='numeric=8,string=1,json=1',
+                        help='relative share of sensors per payload kind')
+    parser.add_argument('--inline', action='store_true', help='parse in the MQTT callback instead of the worker pool')
+    parser.add_argument('--broker', help='publish through this MQTT broker instead of calling on_message directly')
+    args = parser.parse_args()
+
+    influxdb = FakeInfluxDB()
+    influxdb.start()
+    bridge.influxdb_client = InfluxDBClient('127.0.0.1', influxdb.port, bridge.INFLUXDB_USER, bridge.INFLUXDB_PASSWORD)
+    bridge.PIPELINE_ENABLED = not args.inline
+    bridge.METRICS_REPORT_INTERVAL = 0
+    bridge.STATS_INTERVAL = 3600
+
+    messages = sample_messages(args.sensors, args.mix)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.monotonic()
+    if args.broker:
+        sent, elapsed, stop = run_broker(messages, args)
+    else:
+        sent, elapsed, stop = run_direct(messages, args)
+    received = bridge.messages_received.value
+    drained = wait_for_points(influxdb, lambda: bridge.messages_received.value)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if stop is not None:
+        stop()
+
+    offered = f'{args.rate:,.0f}/s' if args.rate else 'unlimited'
+    mode = 'broker' if args.broker else 'inline' if args.inline else 'pipeline'
+    print(f'mode              {mode}, {args.sensors} sensors, mix {args.mix}')
+    print(f'messages sent     {sent:,} in {elapsed:.1f}s = {sent / elapsed:,.0f}/s (offered {offered})')
+    print(f'messages received {received:,}')
+    print(f'points written    {influxdb.points:,} in {influxdb.requests:,} requests, '
+          f'{influxdb.bytes / 1e6:.1f} MB, {influxdb.points / (drained - started):,.0f} points/s sustained')
+    print(f'latency           p50 {percentile(influxdb.latencies, 0.5) * 1e3:.1f} ms, '
+          f'p99 {percentile(influxdb.latencies, 0.99) * 1e3:.1f} ms (receive to InfluxDB)')
+    if bridge.message_queue is not None:
+        print(f'pipeline          {bridge.message_queue.stats()}')
+    # ru_maxrss is in KiB on Linux
+    print(f'peak rss          {rss_after / 1024:.1f} MB (+{(rss_after - rss_before) / 1024:.1f} MB during the run)')
+    influxdb.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""Microbenchmark: decode + flatten + type coercion of ESP JSON payloads
+
+Prints payloads/sec for the plain `json.loads` the bridge used to do, and
+for `JsonIngest.decode` with the stdlib parser and with the faster parser
+json_ingest picked up (orjson/ujson), if any.
+
+    $ python3 bench_json_ingest.py [payloads]
+
+"""
+
+import json
+import sys
+import time
+
+import json_ingest
+from json_ingest import JsonIngest
+
+# what 05-dht11_mqtt publishes on system_info and startup_info_json
+SYSTEM_INFO = json.dumps({
+    'hfree': 41864, 'hmax': 40928, 'hfrag': 2, 'CycleCount': 3121826316, 'Vcc': 3051, 'FreeContStack': 3216,
+    'mqttMessagesSent': 183244, 'dht11SuccessfulReadings': 91620, 'dht11TotalReadings': 91622,
+})
+STARTUP_INFO_JSON = json.dumps({
+    'ResetInfo': 'Fatal exception:0 flag:6 (EXT_SYS_RST) epc1:0x00000000 epc2:0x00000000 epc3:0x00000000',
+    'ResetReason': 'External System', 'LocalIP': '192.168.1.73', 'MacAddress': '5C:CF:7F:12:34:56',
+    'SSID': 'home', 'BSSIDstr': 'A0:04:60:12:34:56', 'SketchMD5': '5d41402abc4b2a76b9719d911017c592',
+    'SketchSize': 389552, 'FreeSketchSpace': 2752512,
+    'FullVersion': 'SDK:2.2.2-dev(38a443e)/Core:2.7.1=20701000/lwIP:STABLE-2_1_2_RELEASE/glue:1.2-30-g92add50/BearSSL:5c771be',
+})
+# a nested payload with a field that alternates between int and float
+NESTED_JSON = json.dumps({
+    'wifi': {'rssi': -61, 'channel': 6}, 'heap': {'free': 41864, 'frag': 2.0}, 'temps': [21.5, 21, 22.25],
+})
+
+
+def sample_payloads(count):
+    payloads = [('system_info', SYSTEM_INFO), ('startup_info_json', STARTUP_INFO_JSON), ('nested_json', NESTED_JSON)]
+    return [payloads[i % len(payloads)] for i in range(count)]
+
+
+def bench_json_loads(payloads):
+    for measurement, payload in payloads:
+        json.loads(payload)
+
+
+def bench_ingest(payloads):
+    ingest = JsonIngest()
+    for measurement, payload in payloads:
+        ingest.decode(measurement, payload)
+
+
+def run(name, fn, payloads, repeat=5):
+    best = min(_timed(fn, payloads) for _ in range(repeat))
+    print(f'{name:<32} {len(payloads) / best:>12,.0f} payloads/s')
+
+
+def _timed(fn, payloads):
+    started = time.perf_counter()
+    fn(payloads)
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    payloads = sample_payloads(count)
+    fast_loads = json_ingest.json_loads
+
+    run('json.loads (no flattening)', bench_json_loads, payloads)
+    json_ingest.json_loads = json.loads
+    run('JsonIngest + json', bench_ingest, payloads)
+    if fast_loads is not json.loads:
+        json_ingest.json_loads = fast_loads
+        run(f'JsonIngest + {fast_loads.__module__}', bench_ingest, payloads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+"""Microbenchmark: line protocol encoder vs. json_body + influxdb make_lines
+
+Encodes the same mix of numeric, string and JSON readings both ways and
+prints points/sec for each.
+
+    $ python3 bench_line_protocol.py [points]
+
+"""
+
+import sys
+import time
+
+from influxdb.line_protocol import make_lines
+
+from line_protocol import LineProtocolEncoder
+from sensor_data import SensorData, SensorDataJson
+
+
+def sample_readings(count):
+    locations = [f'esp{i}' for i in range(20)]
+    readings = []
+    for i in range(count):
+        location = locations[i % len(locations)]
+        kind = i % 10
+        if kind < 7:
+            readings.append(SensorData(location, 'temperature', 20.0 + (i % 100) / 10, None))
+        elif kind < 9:
+            readings.append(SensorData(location, 'state', None, 'on'))
+        else:
+            readings.append(SensorDataJson(location, 'system_info', {'rssi': -67, 'uptime': i, 'version': '1.0.2'}))
+    return readings
+
+
+def json_body(sensor_data, timestamp):
+    """The per-reading dict the bridge used to build for write_points."""
+    point = {
+        'measurement': sensor_data.measurement,
+        'tags': {
+            'location': sensor_data.location
+        },
+        'time': timestamp,
+    }
+    if isinstance(sensor_data, SensorData):
+        point['fields'] = {}
+        if sensor_data.value is not None:
+            point['fields']['value'] = sensor_data.value
+        if sensor_data.value_str is not None:
+            point['fields']['value_str'] = sensor_data.value_str
+    else:
+        point['fields'] = sensor_data.value_dict
+    return point
+
+
+def bench_make_lines(readings, timestamp):
+    return make_lines({'points': [json_body(r, timestamp) for r in readings]}, 'n').encode('utf-8')
+
+
+def bench_encoder(readings, timestamp):
+    encoder = LineProtocolEncoder()
+    buffer = bytearray()
+    for r in readings:
+        encoder.encode_into(buffer, r, timestamp)
+    return bytes(buffer)
+
+
+def run(name, fn, readings, timestamp, repeat=5):
+    best = min(_timed(fn, readings, timestamp) for _ in range(repeat))
+    print(f'{name:<24} {len(readings) / best:>12,.0f} points/s')
+
+
+def _timed(fn, readings, timestamp):
+    started = time.perf_counter()
+    fn(readings, timestamp)
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    readings = sample_readings(count)
+    timestamp = time.time_ns()
+    # same output (field keys are already in the order make_lines sorts them into)
+    assert bench_make_lines(readings, timestamp) == bench_encoder(readings, timestamp)
+    run('json_body + make_lines', bench_make_lines, readings, timestamp)
+    run('LineProtocolEncoder', bench_encoder, readings, timestamp)
+
+
+if __name__ == '__main__':
+    main()
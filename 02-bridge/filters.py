@@ -0,0 +1,177 @@
+"""Per-series deadband, heartbeat and downsampling filter
+
+Sits between the topic parser and the batch writer and decides, per
+`(location, measurement)` series, which numeric readings are worth storing:
+
+- deadband: a reading is dropped when it differs from the last *written*
+  value by no more than `max(deadband, relative_deadband * abs(last))`.
+  With both at 0 only exact repeats are dropped (change-only filtering).
+- heartbeat: a reading is always written once `max_silence` seconds have
+  passed since the last write, so flat lines still show up in Grafana.
+- window: with `window` > 0, readings are first folded into one
+  `aggregate` (mean, min or max) per `window` seconds, and that value goes
+  through the deadband instead.
+
+String readings of a filtered series are change-only; JSON readings and
+series without a rule are passed straight through.
+
+"""
+
+import threading
+import time
+from typing import NamedTuple
+
+from sensor_data import SensorData
+
+WILDCARD = '*'
+AGGREGATES = ('mean', 'min', 'max')
+
+
+class FilterRule(NamedTuple):
+    deadband: float = 0.0  # absolute, in the unit of the reading
+    relative_deadband: float = 0.0  # fraction of the last written value
+    max_silence: float = 300.0  # seconds
+    window: float = 0.0  # seconds, 0 disables aggregation
+    aggregate: str = 'mean'
+
+
+class SeriesState:
+    __slots__ = (
+        'rule',
+        'last_value',
+        'last_time',
+        'window_end',
+        'window_count',
+        'window_sum',
+        'window_min',
+        'window_max',
+        'window_time',
+    )
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.last_value = None
+        self.last_time = None
+        self.window_end = None
+        self.window_count = 0
+        self.window_sum = 0.0
+        self.window_min = 0.0
+        self.window_max = 0.0
+        self.window_time = 0
+
+
+class SeriesFilter:
+    def __init__(self, rules, emit, flush_interval=1.0):
+        """
+        `rules` maps `(location, measurement)` to a `FilterRule`; either key may be `'*'`.
+        `emit(sensor_data, timestamp)` is called for every reading that should be written.
+        """
+        for rule in rules.values():
+            if rule.aggregate not in AGGREGATES:
+                raise ValueError(f'unknown aggregate {rule.aggregate!r}, expected one of {AGGREGATES}')
+        self.rules = rules
+        self._emit = emit
+        self.flush_interval = flush_interval
+        self._series = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='series-filter', daemon=True)
+
+        self.passed = 0
+        self.suppressed = 0
+        self.aggregated = 0
+
+    def stats(self):
+        return {
+            'series': len(self._series),
+            'passed': self.passed,
+            'suppressed': self.suppressed,
+            'aggregated': self.aggregated,
+        }
+
+    def start(self):
+        """Start flushing windows of series that went quiet (only needed when a rule has a window)."""
+        if any(rule.window for rule in self.rules.values()):
+            self._thread.start()
+
+    def rule_for(self, location, measurement):
+        for key in ((location, measurement), (WILDCARD, measurement), (location, WILDCARD), (WILDCARD, WILDCARD)):
+            rule = self.rules.get(key)
+            if rule is not None:
+                return rule
+        return None
+
+    def process(self, sensor_data, timestamp):
+        if not isinstance(sensor_data, SensorData):
+            self._emit(sensor_data, timestamp)
+            return
+        key = (sensor_data.location, sensor_data.measurement)
+        with self._lock:
+            state = self._series.get(key)
+            if state is None:
+                state = self._series[key] = SeriesState(self.rule_for(*key))
+            if state.rule is None:
+                self.passed += 1
+                self._emit(sensor_data, timestamp)
+            elif sensor_data.value is None:
+                self._filter(state, sensor_data, sensor_data.value_str, timestamp)
+            elif state.rule.window:
+                self._add_to_window(state, sensor_data, timestamp)
+            else:
+                self._filter(state, sensor_data, sensor_data.value, timestamp)
+
+    def flush_expired(self, now=None):
+        """Emit the aggregate of every window that ended before `now` (ns)."""
+        if now is None:
+            now = time.time_ns()
+        with self._lock:
+            for (location, measurement), state in self._series.items():
+                if state.window_count and state.window_end <= now:
+                    self._close_window(state, location, measurement)
+
+    def _filter(self, state, sensor_data, value, timestamp):
+        rule = state.rule
+        if state.last_time is not None and timestamp - state.last_time < rule.max_silence * 1e9:
+            if isinstance(value, str) or isinstance(state.last_value, str):
+                unchanged = value == state.last_value
+            else:
+                unchanged = abs(value - state.last_value) <= max(rule.deadband, rule.relative_deadband * abs(state.last_value))
+            if unchanged:
+                self.suppressed += 1
+                return
+        state.last_value = value
+        state.last_time = timestamp
+        self.passed += 1
+        self._emit(sensor_data, timestamp)
+
+    def _add_to_window(self, state, sensor_data, timestamp):
+        if state.window_count and timestamp >= state.window_end:
+            self._close_window(state, sensor_data.location, sensor_data.measurement)
+        value = sensor_data.value
+        if not state.window_count:
+            state.window_end = timestamp + int(state.rule.window * 1e9)
+            state.window_sum = 0.0
+            state.window_min = value
+            state.window_max = value
+        state.window_count += 1
+        state.window_sum += value
+        state.window_min = min(state.window_min, value)
+        state.window_max = max(state.window_max, value)
+        state.window_time = timestamp
+
+    def _close_window(self, state, location, measurement):
+        aggregate = state.rule.aggregate
+        if aggregate == 'mean':
+            value = state.window_sum / state.window_count
+        elif aggregate == 'min':
+            value = state.window_min
+        else:
+            value = state.window_max
+        # every sample but the one written stands in for a suppressed point
+        self.aggregated += state.window_count - 1
+        state.window_count = 0
+        self._filter(state, SensorData(location, measurement, value, None), value, state.window_time)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_expired()
@@ -0,0 +1,163 @@
+"""Schema-aware JSON decoding for `*json` and `system_info` topics
+
+Turns a JSON payload into flat InfluxDB fields:
+
+- nested objects and lists are flattened into dotted field names
+  (`{"wifi": {"rssi": -60}, "t": [1, 2]}` -> `wifi.rssi`, `t.0`, `t.1`)
+- a payload that is not an object is stored as the field `value`
+- every field is coerced to the type it had the first time it was written
+  for that measurement (InfluxDB rejects the whole write on a field type
+  conflict, e.g. a float for a field that was first written as an int)
+
+The type of each field is cached per measurement. It is seeded from
+`load_schema(measurement)` when given (e.g. `SHOW FIELD KEYS` on InfluxDB),
+so a restart does not forget types written by a previous run, or up front
+for every measurement with `add_schemas` when loading them lazily would
+block (e.g. on an event loop).
+
+orjson or ujson are used for parsing when installed.
+
+"""
+
+import logging
+import threading
+
+try:
+    import orjson as _json_impl
+except ImportError:
+    try:
+        import ujson as _json_impl
+    except ImportError:
+        import json as _json_impl
+
+json_loads = _json_impl.loads
+
+log = logging.getLogger(__name__)
+
+FLOAT = 'float'
+INTEGER = 'integer'
+STRING = 'string'
+BOOLEAN = 'boolean'
+
+# InfluxDB integers are signed 64 bit
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def flatten(value, prefix=None, fields=None):
+    """Flatten nested dicts/lists into `{dotted.name: scalar}`."""
+    if fields is None:
+        fields = {}
+        if not isinstance(value, (dict, list)):
+            if value is not None:
+                fields['value'] = value
+            return fields
+        if isinstance(value, list):
+            prefix = 'value'
+    for key, item in value.items() if isinstance(value, dict) else enumerate(value):
+        name = key if prefix is None else f'{prefix}.{key}'
+        if isinstance(item, (dict, list)):
+            flatten(item, name, fields)
+        elif item is not None:
+            fields[name] = item
+    return fields
+
+
+_FIELD_TYPES = {bool: BOOLEAN, int: INTEGER, float: FLOAT, str: STRING}
+
+
+def field_type(value):
+    kind = _FIELD_TYPES.get(type(value), STRING)
+    if kind == INTEGER and not MIN_INTEGER <= value <= MAX_INTEGER:
+        return FLOAT
+    return kind
+
+
+def coerce(value, target):
+    """Convert `value` to the InfluxDB field type `target`, or return None if it cannot be."""
+    if target == STRING:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+    if target == BOOLEAN:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        return None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+    if target == FLOAT:
+        return float(value)
+    # INTEGER
+    if isinstance(value, float):
+        if value != value or value in (float('inf'), float('-inf')):
+            return None
+        value = round(value)
+    return value if MIN_INTEGER <= value <= MAX_INTEGER else None
+
+
+class JsonIngest:
+    def __init__(self, load_schema=None):
+        """`load_schema(measurement)` returns `{field: type}` already stored in InfluxDB."""
+        self._load_schema = load_schema
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+        self.coerced = 0
+        self.dropped = 0
+
+    def add_schemas(self, schemas):
+        """Seed `{measurement: {field: type}}` loaded ahead of time; fields already learned are kept."""
+        with self._lock:
+            for measurement, schema in schemas.items():
+                known = self._schemas.setdefault(measurement, {})
+                for name, stored_type in schema.items():
+                    known.setdefault(name, stored_type)
+
+    def schema(self, measurement):
+        schema = self._schemas.get(measurement)
+        if schema is None:
+            schema = {}
+            if self._load_schema is not None:
+                try:
+                    schema = dict(self._load_schema(measurement))
+                except Exception as e:
+                    log.warning(f'could not load the field types of {measurement}, learning them from the data: {e!r}')
+            with self._lock:
+                schema = self._schemas.setdefault(measurement, schema)
+        return schema
+
+    def decode(self, measurement, payload):
+        """Parse `payload` (str or bytes) into a flat dict of fields with consistent types."""
+        fields = flatten(json_loads(payload))
+        schema = self.schema(measurement)
+        changes = None
+        for name, value in fields.items():
+            actual = field_type(value)
+            expected = schema.get(name)
+            if expected is None:
+                with self._lock:
+                    expected = schema.setdefault(name, actual)
+            if expected == actual and (actual != FLOAT or type(value) is float):
+                continue
+            if changes is None:
+                changes = []
+            # coerce also turns integers too large for InfluxDB into floats
+            changes.append((name, coerce(value, expected)))
+        if changes is not None:
+            for name, value in changes:
+                if value is None:
+                    del fields[name]
+                    self.dropped += 1
+                else:
+                    fields[name] = value
+                    self.coerced += 1
+        return fields
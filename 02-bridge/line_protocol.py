@@ -0,0 +1,105 @@
+"""InfluxDB line protocol encoder for `SensorData` and `SensorDataJson`
+
+Encodes readings straight into a caller-supplied `bytearray`, instead of
+building a `json_body` dict per reading that the influxdb client then turns
+into line protocol. The escaped `measurement,location=...` prefix is cached
+per `(location, measurement)` and escaped field keys are cached per name, so
+the per-reading work is a dict lookup plus formatting the values.
+
+Escaping and value formatting follow `influxdb.line_protocol.make_lines`,
+which also leaves out an empty location tag, as InfluxDB rejects empty tag
+values.
+
+"""
+
+import math
+
+from sensor_data import SensorData, SensorDataJson
+
+# topics are a small fixed set, this only guards against a misbehaving publisher
+MAX_CACHED_KEYS = 10000
+
+
+def escape_key(key):
+    """Escape a measurement name, tag key/value or field key."""
+    return (str(key)
+        .replace('\\', '\\\\')
+        .replace(' ', '\\ ')
+        .replace(',', '\\,')
+        .replace('=', '\\=')
+        .replace('\n', '\\n')
+        .encode('utf-8')
+    )
+
+
+def encode_value(value):
+    """Encode a field value, or return None for values InfluxDB would reject."""
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, int):
+        return b'%di' % value
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return None
+        return repr(value).encode('ascii')
+    if isinstance(value, str):
+        return b'"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf-8') + b'"'
+    return None
+
+
+class LineProtocolEncoder:
+    def __init__(self):
+        self._prefixes = {}
+        self._field_keys = {}
+
+    def prefix(self, location, measurement):
+        """`measurement,location=<location> ` with everything escaped, or `measurement ` for an empty location."""
+        key = (location, measurement)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            if len(self._prefixes) >= MAX_CACHED_KEYS:
+                self._prefixes.clear()
+            prefix = escape_key(measurement)
+            escaped_location = escape_key(location)
+            if escaped_location:
+                prefix += b',location=' + escaped_location
+            prefix += b' '
+            self._prefixes[key] = prefix
+        return prefix
+
+    def field_key(self, name):
+        field_key = self._field_keys.get(name)
+        if field_key is None:
+            if len(self._field_keys) >= MAX_CACHED_KEYS:
+                self._field_keys.clear()
+            field_key = escape_key(name) + b'='
+            self._field_keys[name] = field_key
+        return field_key
+
+    def encode_into(self, buffer, sensor_data, timestamp):
+        """Append one line for `sensor_data` to `buffer`; returns the number of lines written (0 or 1)."""
+        if isinstance(sensor_data, SensorData):
+            if sensor_data.value is not None:
+                fields = encode_value(sensor_data.value)
+                if fields is not None:
+                    fields = b'value=' + fields
+            else:
+                fields = None
+            if sensor_data.value_str is not None:
+                value_str = b'value_str=' + encode_value(sensor_data.value_str)
+                fields = value_str if fields is None else fields + b',' + value_str
+        elif isinstance(sensor_data, SensorDataJson):
+            fields = b','.join(
+                self.field_key(name) + encoded
+                for name, encoded in ((name, encode_value(value)) for name, value in sensor_data.value_dict.items())
+                if encoded is not None
+            )
+        else:
+            raise TypeError(f'cannot encode {type(sensor_data).__name__}')
+
+        if not fields:
+            return 0
+        buffer += self.prefix(sensor_data.location, sensor_data.measurement)
+        buffer += fields
+        buffer += b' %d\n' % timestamp
+        return 1
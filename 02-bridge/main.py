@@ -6,91 +6,253 @@ This script receives MQTT data and saves those to InfluxDB.
 
 """
 
-import re
-import json
-from typing import NamedTuple
+import logging
+import threading
+import time
 
 import paho.mqtt.client as mqtt
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+
+from batch_writer import BatchWriter, RejectedBatch, is_rejection
+from filters import FilterRule, SeriesFilter  # noqa: F401 -- FilterRule is for writing FILTER_RULES below
+from json_ingest import JsonIngest, json_loads
+from line_protocol import LineProtocolEncoder
+import metrics
+import pipeline
+from sensor_data import SensorData, SensorDataJson
+from spool import Spool, SpoolReplayer
+import topic_router
+from topic_router import TopicRouter, TopicRule
 
 INFLUXDB_ADDRESS = 'influxdb'
 INFLUXDB_USER = 'root'
 INFLUXDB_PASSWORD = 'root'
 INFLUXDB_DATABASE = 'home_db'
+INFLUXDB_BATCH_SIZE = 5000  # points per write request
+INFLUXDB_FLUSH_INTERVAL = 1.0  # seconds a point may wait in the buffer
+INFLUXDB_WRITE_WORKERS = 2  # concurrent batch writes
+
+# Batches InfluxDB rejects or times out on are spooled here and replayed once it is back
+SPOOL_DIRECTORY = '/spool'
+SPOOL_SEGMENT_SIZE = 16 * 1024 * 1024  # bytes
+SPOOL_FSYNC_INTERVAL = 1.0  # seconds
+SPOOL_REPLAY_RATE = 20000  # points per second
 
 MQTT_ADDRESS = 'mosquitto'
 MQTT_USER = 'mqttuser'
 MQTT_PASSWORD = 'mqttpassword'
-MQTT_TOPIC = 'home/+/+'  # [bme280|mijia]/[temperature|humidity|battery|status]
-MQTT_REGEX = 'home/([^/]+)/([^/]+)'
+MQTT_TOPIC_RULES = [
+    TopicRule('home/{location}/{measurement}'),  # [bme280|mijia]/[temperature|humidity|battery|status]
+    # e.g. TopicRule('tele/{location}/SENSOR', measurement='tasmota_json', kind=topic_router.JSON),
+]
+MQTT_TOPIC_CACHE_SIZE = 4096  # distinct topics
 MQTT_CLIENT_ID = 'MQTTInfluxDBBridge'
 
+# When enabled, the paho callback only enqueues messages and a pool of workers parses them
+PIPELINE_ENABLED = True
+PIPELINE_QUEUE_SIZE = 10000  # messages
+PIPELINE_WORKERS = 2
+PIPELINE_BACKPRESSURE = pipeline.BLOCK  # [block|drop-oldest|spill]
+PIPELINE_SPILL_PATH = '/tmp/mqttbridge-spill.log'
+
+# Per-series deadband/heartbeat/downsampling, keyed by (location, measurement); '*' matches anything.
+# Series without a rule are written as received.
+FILTER_RULES = {
+    # ('bme280', 'temperature'): FilterRule(deadband=0.1, max_silence=300),
+    # ('*', 'humidity'): FilterRule(relative_deadband=0.01),
+    # ('*', 'pressure'): FilterRule(window=60, aggregate='mean'),
+}
+
+STATS_INTERVAL = 60  # seconds between logging pipeline and filter counters
+
+LOG_LEVEL = 'INFO'
+MESSAGE_LOG_SAMPLE_RATE = 1000  # log one in this many received messages, at DEBUG level
+METRICS_PORT = 9110  # serves /metrics, None to disable
+METRICS_REPORT_INTERVAL = 60  # seconds between writing the bridge metrics to InfluxDB, 0 to disable
+METRICS_MEASUREMENT = 'mqttbridge_metrics'
+
+# buffered readings taken later than this (unix seconds) do not fit InfluxDB's int64 nanosecond timestamps
+MAX_SAMPLE_TIME = 2 ** 63 // 10 ** 9
+
+log = logging.getLogger(__name__)
+
+registry = metrics.Registry()
+messages_received = registry.counter('bridge_messages_received_total', 'MQTT messages received')
+messages_by_location = registry.labeled_counter(
+    'bridge_messages_by_location_total', 'Routed MQTT messages per location', 'location')
+parse_seconds = registry.histogram('bridge_parse_seconds', 'Time spent routing and parsing a message')
+queue_wait_seconds = registry.histogram('bridge_queue_wait_seconds', 'Time a message waited in the pipeline queue')
+batch_points = registry.histogram('bridge_batch_points', 'Points per InfluxDB write', metrics.BATCH_SIZE_BUCKETS)
+write_seconds = registry.histogram('bridge_write_seconds', 'InfluxDB write latency')
+points_written = registry.counter('bridge_points_written_total', 'Points written to InfluxDB')
+write_failures = registry.counter('bridge_write_failures_total', 'Failed InfluxDB writes')
+readings_dropped = registry.counter('bridge_readings_dropped_total', 'Buffered readings dropped for a null or non-scalar value')
+points_failed = registry.counter('bridge_points_failed_total', 'Points in failed InfluxDB writes (spooled unless rejected)')
+
 influxdb_client = InfluxDBClient(INFLUXDB_ADDRESS, 8086, INFLUXDB_USER, INFLUXDB_PASSWORD, None)
+spool = None
 
 
-class SensorData(NamedTuple):
-    location: str
-    measurement: str
-    value: float
-    value_str: str
+def _write_line_protocol(body):
+    try:
+        influxdb_client.request(
+            url='write',
+            method='POST',
+            params={'db': INFLUXDB_DATABASE, 'precision': 'n'},
+            data=body,
+            expected_response_code=204,
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+    except InfluxDBClientError as e:
+        if e.code is not None and is_rejection(e.code):
+            raise RejectedBatch(str(e)) from e
+        raise
+
+
+def _spool_lines(body):
+    if spool is None:
+        return
+    spool.append(body)
+
+
+def _observe_write(count, seconds, succeeded):
+    batch_points.observe(count)
+    write_seconds.observe(seconds)
+    if succeeded:
+        points_written.inc(count)
+    else:
+        write_failures.inc()
+        points_failed.inc(count)
+
+
+encoder = LineProtocolEncoder()
+batch_writer = BatchWriter(
+    _write_line_protocol,
+    encoder.encode_into,
+    batch_size=INFLUXDB_BATCH_SIZE,
+    flush_interval=INFLUXDB_FLUSH_INTERVAL,
+    workers=INFLUXDB_WRITE_WORKERS,
+    on_failure=_spool_lines,
+    on_write=_observe_write,
+)
+
+
+def _load_field_types(measurement):
+    query = 'SHOW FIELD KEYS FROM "{}"'.format(measurement.replace('\\', '\\\\').replace('"', '\\"'))
+    result = influxdb_client.query(query, database=INFLUXDB_DATABASE)
+    return {field['fieldKey']: field['fieldType'] for field in result.get_points()}
+
+
+json_ingest = JsonIngest(_load_field_types)
+message_queue = None
+series_filter = SeriesFilter(FILTER_RULES, batch_writer.add) if FILTER_RULES else None
+router = TopicRouter(MQTT_TOPIC_RULES, MQTT_TOPIC_CACHE_SIZE)
+subscription_prefix = ''
+accept_topic = None
+
+registry.gauge('bridge_queue_depth', 'Messages waiting in the pipeline queue',
+               lambda: message_queue.depth() if message_queue is not None else 0)
+registry.gauge('bridge_queue_dropped_total', 'Messages dropped by the drop-oldest policy',
+               lambda: message_queue.dropped if message_queue is not None else 0, 'counter')
+registry.gauge('bridge_queue_spilled_total', 'Messages spilled to disk by the spill policy',
+               lambda: message_queue.spilled if message_queue is not None else 0, 'counter')
+registry.gauge('bridge_filter_suppressed_total', 'Readings suppressed by the deadband filter',
+               lambda: series_filter.suppressed if series_filter is not None else 0, 'counter')
+registry.gauge('bridge_filter_aggregated_total', 'Readings folded into window aggregates',
+               lambda: series_filter.aggregated if series_filter is not None else 0, 'counter')
+registry.gauge('bridge_json_coerced_total', 'JSON fields coerced to their stored type',
+               lambda: json_ingest.coerced, 'counter')
+registry.gauge('bridge_json_dropped_total', 'JSON fields dropped for a type conflict',
+               lambda: json_ingest.dropped, 'counter')
+registry.gauge('bridge_writer_callback_errors_total', 'Spool or instrumentation callbacks that raised in the batch writer',
+               lambda: batch_writer.callback_errors, 'counter')
+registry.gauge('bridge_spool_segments', 'Spool segments waiting to be replayed',
+               lambda: len(spool) if spool is not None else 0)
 
-class SensorDataJson(NamedTuple):
-    location: str
-    measurement: str
-    value_dict: dict
 
 def on_connect(client, userdata, flags, rc):
     """ The callback for when the client receives a CONNACK response from the server."""
-    print('Connected with result code ' + str(rc))
-    client.subscribe(MQTT_TOPIC)
+    log.info('Connected with result code ' + str(rc))
+    client.subscribe([(subscription_prefix + subscription, 0) for subscription in router.subscriptions])
 
 
 def on_message(client, userdata, msg):
     """The callback for when a PUBLISH message is received from the server."""
-    print(msg.topic + ' ' + str(msg.payload))
-    sensor_data = _parse_mqtt_message(msg.topic, msg.payload.decode('utf-8'))
-    if sensor_data is not None:
-        _send_sensor_data_to_influxdb(sensor_data)
-
-
-def _parse_mqtt_message(topic, payload):
-    match = re.match(MQTT_REGEX, topic)
-    if match:
-        location = match.group(1)
-        measurement = match.group(2)
-        if measurement == 'status':
-            return None
-        if measurement == 'system_info' or measurement.endswith('json'):
-            return SensorDataJson(location, measurement, json.loads(payload))
-        try:
-            return SensorData(location, measurement, float(payload), None)
-        except ValueError:
-            return SensorData(location, measurement, None, payload)
+    receive_time = time.time_ns()
+    if accept_topic is not None and not accept_topic(msg.topic):
+        return
+    messages_received.inc()
+    if messages_received.value % MESSAGE_LOG_SAMPLE_RATE == 0:
+        log.debug('%s %r', msg.topic, msg.payload)
+    if message_queue is not None:
+        message_queue.put((msg.topic, msg.payload, receive_time))
     else:
-        return None
+        try:
+            _handle_message(msg.topic, msg.payload, receive_time)
+        except Exception as e:
+            # an exception raised here would stop the paho network loop
+            log.warning(f'failed to handle message on {msg.topic}: {e!r}')
+
+
+def _handle_message(topic, payload, receive_time):
+    started = time.perf_counter()
+    if message_queue is not None:
+        queue_wait_seconds.observe((time.time_ns() - receive_time) / 1e9)
+    route = router.route(topic)
+    if route is None or route.kind == topic_router.IGNORE:
+        return
+    messages_by_location.inc(route.location)
+    payload, timestamp = _split_sample_time(route, payload.decode('utf-8'), receive_time)
+    if payload is None:
+        return
+    sensor_data = _parse_mqtt_message(route, payload)
+    parse_seconds.observe(time.perf_counter() - started)
+    _send_sensor_data_to_influxdb(sensor_data, timestamp)
 
 
-def _send_sensor_data_to_influxdb(sensor_data):
-    json_body = [
-        {
-            'measurement': sensor_data.measurement,
-            'tags': {
-                'location': sensor_data.location
-            }
-        }
-    ]
+def _split_sample_time(route, payload, receive_time):
+    """
+    Unwrap `{"t": <unix seconds>, "v": <value>}` payloads, which publishers that buffer readings
+    while offline send, into the value and the time it was taken (ns).
+    A sample time that is not a finite time InfluxDB can store falls back to `receive_time`;
+    a reading whose value is null or not a scalar is dropped by returning a None payload.
+    Anything else is returned as is, stamped with `receive_time`.
+    """
+    if route.kind == topic_router.JSON or not payload.startswith('{'):
+        return payload, receive_time
+    try:
+        reading = json_loads(payload)
+        value = reading['v']
+        sample_time = float(reading['t'])
+    except (ValueError, TypeError, KeyError):
+        return payload, receive_time
+    if value is None or not isinstance(value, (str, int, float)):
+        readings_dropped.inc()
+        return None, None
+    if not 0 <= sample_time < MAX_SAMPLE_TIME:
+        # also false for nan
+        return str(value), receive_time
+    return str(value), round(sample_time * 1e3) * 1000000
 
-    if isinstance(sensor_data, SensorData):
-        json_body[0]['fields'] = {}
-        if sensor_data.value is not None:
-            json_body[0]['fields']['value'] = sensor_data.value
-        if sensor_data.value_str is not None:
-            json_body[0]['fields']['value_str'] = sensor_data.value_str
 
-    elif isinstance(sensor_data, SensorDataJson):
-        json_body[0]['fields'] = sensor_data.value_dict
+def _parse_mqtt_message(route, payload):
+    if route.kind == topic_router.JSON:
+        return SensorDataJson(route.location, route.measurement, json_ingest.decode(route.measurement, payload))
+    if route.kind == topic_router.NUMERIC:
+        try:
+            return SensorData(route.location, route.measurement, float(payload), None)
+        except ValueError:
+            pass
+    return SensorData(route.location, route.measurement, None, payload)
+
 
-    influxdb_client.write_points(json_body)
+def _send_sensor_data_to_influxdb(sensor_data, timestamp):
+    """Queue a reading for the next batched write, stamped with `timestamp` (ns)."""
+    if series_filter is not None:
+        series_filter.process(sensor_data, timestamp)
+    else:
+        batch_writer.add(sensor_data, timestamp)
 
 
 def _init_influxdb_database():
@@ -100,18 +262,93 @@ def _init_influxdb_database():
     influxdb_client.switch_database(INFLUXDB_DATABASE)
 
 
-def main():
+def _report_stats():
+    while True:
+        time.sleep(STATS_INTERVAL)
+        if message_queue is not None:
+            log.info(f'pipeline: {message_queue.stats()}')
+        if series_filter is not None:
+            log.info(f'filter: {series_filter.stats()}')
+        log.info(f'json: coerced {json_ingest.coerced} fields, dropped {json_ingest.dropped}')
+
+
+def _report_metrics(client_id):
+    """Write the bridge's own metrics to InfluxDB, tagged with the MQTT client id as location."""
+    while True:
+        time.sleep(METRICS_REPORT_INTERVAL)
+        try:
+            batch_writer.add(SensorDataJson(client_id, METRICS_MEASUREMENT, registry.snapshot()), time.time_ns())
+        except Exception as e:
+            log.warning(f'failed to report the bridge metrics: {e!r}')
+
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def start(spool_directory=SPOOL_DIRECTORY, spill_path=PIPELINE_SPILL_PATH):
+    """Start the spool, batch writer, pipeline workers and filter; returns a function that stops them."""
+    global message_queue
+    global spool
+
+    spool = Spool(spool_directory, SPOOL_SEGMENT_SIZE, SPOOL_FSYNC_INTERVAL)
+    spool_replayer = SpoolReplayer(spool, _write_line_protocol, INFLUXDB_BATCH_SIZE, SPOOL_REPLAY_RATE)
+    spool_replayer.start()
+    batch_writer.start()
+
+    workers = None
+    if PIPELINE_ENABLED:
+        message_queue = pipeline.MessageQueue(PIPELINE_QUEUE_SIZE, PIPELINE_BACKPRESSURE, spill_path)
+        workers = pipeline.WorkerPool(message_queue, _handle_message, PIPELINE_WORKERS)
+        workers.start()
+    if series_filter is not None:
+        series_filter.start()
+
+    def stop():
+        if workers is not None:
+            workers.stop()
+        batch_writer.stop()
+        spool_replayer.stop()
+        spool.close()
+
+    return stop
+
+
+def main(client_id=MQTT_CLIENT_ID, topic_prefix='', topic_filter=None,
+         spool_directory=SPOOL_DIRECTORY, spill_path=PIPELINE_SPILL_PATH, metrics_port=METRICS_PORT):
+    """
+    Run the bridge until interrupted.
+
+    `topic_prefix` is prepended to every subscription (e.g. `$share/<group>/`), and when
+    `topic_filter` is given, only topics for which it returns True are handled.
+    """
+    global subscription_prefix
+    global accept_topic
+
+    subscription_prefix = topic_prefix
+    accept_topic = topic_filter
+
     _init_influxdb_database()
+    stop = start(spool_directory, spill_path)
+    threading.Thread(target=_report_stats, name='bridge-stats', daemon=True).start()
+    if metrics_port is not None:
+        registry.serve(metrics_port)
+    if METRICS_REPORT_INTERVAL:
+        threading.Thread(target=_report_metrics, args=(client_id,), name='bridge-metrics', daemon=True).start()
 
-    mqtt_client = mqtt.Client(MQTT_CLIENT_ID)
+    mqtt_client = mqtt.Client(client_id)
     mqtt_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
 
     mqtt_client.connect(MQTT_ADDRESS, 1883)
-    mqtt_client.loop_forever()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        stop()
 
 
 if __name__ == '__main__':
-    print('MQTT to InfluxDB bridge')
+    configure_logging()
+    log.info('MQTT to InfluxDB bridge')
     main()
@@ -0,0 +1,191 @@
+"""Low-overhead bridge instrumentation
+
+Counters, gauges and fixed-bucket histograms kept in plain Python objects,
+rendered in the Prometheus text format on a local HTTP `/metrics` endpoint
+and flattened into a dict for self-reporting into InfluxDB.
+
+"""
+
+import bisect
+import http.server
+import threading
+
+# seconds, from 10us to 10s
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+# points per batch
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        yield f'{self.name} {self.value}'
+
+    def snapshot(self):
+        return {self.name: self.value}
+
+
+class LabeledCounter:
+    """A counter per value of one label, e.g. per location."""
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for label_value, value in sorted(self.items()):
+            escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            yield f'{self.name}{{{self.label}="{escaped}"}} {value}'
+
+    def items(self):
+        """A copy of the `(label value, count)` pairs, safe to iterate while other threads add labels."""
+        with self._lock:
+            return list(self.values.items())
+
+    def snapshot(self):
+        return {f'{self.name}.{label_value}': value for label_value, value in self.items()}
+
+
+class Gauge:
+    """A value read from `read()` whenever the metrics are collected.
+
+    `type` can be set to `counter` for values some other object already counts.
+    """
+
+    def __init__(self, name, help, read, type='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.type = type
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield f'{self.name} {self.read()}'
+
+    def snapshot(self):
+        return {self.name: self.read()}
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile (None without observations)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        yield f'{self.name}_bucket{{le="+Inf"}} {self.count}'
+        yield f'{self.name}_sum {self.sum}'
+        yield f'{self.name}_count {self.count}'
+
+    def snapshot(self):
+        snapshot = {f'{self.name}.count': self.count, f'{self.name}.sum': self.sum}
+        for q in (0.5, 0.99):
+            value = self.quantile(q)
+            if value is not None and value != float('inf'):
+                snapshot[f'{self.name}.p{int(q * 100)}'] = value
+        return snapshot
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def labeled_counter(self, name, help, label):
+        return self.register(LabeledCounter(name, help, label))
+
+    def gauge(self, name, help, read, type='gauge'):
+        return self.register(Gauge(name, help, read, type))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        return ''.join(f'{line}\n' for metric in self.metrics for line in metric.render())
+
+    def snapshot(self):
+        """All metrics as one flat `{name: number}` dict."""
+        snapshot = {}
+        for metric in self.metrics:
+            snapshot.update(metric.snapshot())
+        return snapshot
+
+    def serve(self, port, address=''):
+        """Serve `/metrics` on a background thread."""
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        return server
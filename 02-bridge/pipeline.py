@@ -0,0 +1,171 @@
+"""Bounded message queue and worker pool for the MQTT bridge
+
+The paho callback only enqueues raw `(topic, payload, receive_time)` tuples;
+a pool of worker threads drains the queue, so a slow InfluxDB never stalls
+the MQTT network loop. What happens when the queue is full is decided by
+the backpressure policy:
+
+- `block`: the producer waits for room (backpressure reaches the broker via TCP)
+- `drop-oldest`: the oldest queued message is discarded to make room
+- `spill`: overflow is appended to a local file and read back, in order, once
+  the workers have caught up
+
+"""
+
+import collections
+import logging
+import threading
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+log = logging.getLogger(__name__)
+
+
+class SpillFile:
+    """
+    Append-only overflow file of `(topic, payload, receive_time)` records,
+    one per line, with the topic and payload hex-encoded so that neither can
+    contain the separators.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._read_offset = 0
+        # start from scratch, anything left over from a previous run is stale
+        self._file = open(self.path, 'wb')
+
+    def append(self, item):
+        topic, payload, receive_time = item
+        self._file.write(b'%d %s %s\n' % (receive_time, topic.encode('utf-8').hex().encode('ascii'),
+                                           payload.hex().encode('ascii')))
+        self._file.flush()
+        self.count += 1
+
+    def read(self, max_items):
+        """Read up to `max_items` records, oldest first."""
+        items = []
+        read = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self._read_offset)
+            while len(items) < max_items:
+                line = f.readline()
+                if not line:
+                    break
+                read += 1
+                try:
+                    receive_time, topic, payload = line.split(b' ')
+                    items.append((bytes.fromhex(topic.decode('ascii')).decode('utf-8'),
+                                  bytes.fromhex(payload.decode('ascii')), int(receive_time)))
+                except ValueError as e:
+                    # UnicodeDecodeError included; skip it rather than stall every worker on it
+                    log.warning(f'skipping unreadable spill record {line[:80]!r}: {e!r}')
+            self._read_offset = f.tell()
+        self.count -= read
+        if self.count == 0:
+            # fully drained, reclaim the disk space
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_offset = 0
+        return items
+
+
+class MessageQueue:
+    def __init__(self, maxsize, policy=BLOCK, spill_path=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown backpressure policy {policy!r}, expected one of {POLICIES}')
+        if policy == SPILL and spill_path is None:
+            raise ValueError('the spill policy needs a spill_path')
+        self.maxsize = maxsize
+        self.policy = policy
+        self._items = collections.deque()
+        self._spill = SpillFile(spill_path) if policy == SPILL else None
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def depth(self):
+        return len(self._items) + (self._spill.count if self._spill is not None else 0)
+
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+        }
+
+    def put(self, item):
+        with self._cond:
+            self.enqueued += 1
+            if self._spill is not None and (self._spill.count or len(self._items) >= self.maxsize):
+                # once anything is spilled, keep spilling so ordering is preserved
+                self._spill.append(item)
+                self.spilled += 1
+            else:
+                if len(self._items) >= self.maxsize:
+                    if self.policy == DROP_OLDEST:
+                        self._items.popleft()
+                        self.dropped += 1
+                    else:
+                        while len(self._items) >= self.maxsize and not self._closed:
+                            self._cond.wait()
+                self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self):
+        """Return the next item, or None once the queue is closed and empty."""
+        with self._cond:
+            while True:
+                if not self._items and self._spill is not None and self._spill.count:
+                    self._items.extend(self._spill.read(self.maxsize))
+                if self._items:
+                    item = self._items.popleft()
+                    self._cond.notify_all()
+                    return item
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def close(self):
+        """Let the consumers drain what is left and then return None."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class WorkerPool:
+    def __init__(self, queue, handle, workers=2):
+        """Run `handle(topic, payload, receive_time)` for every queued message."""
+        self.queue = queue
+        self._handle = handle
+        self._threads = [
+            threading.Thread(target=self._run, name=f'bridge-worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self.queue.close()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._handle(*item)
+            except Exception as e:
+                log.warning(f'failed to handle message on {item[0]}: {e!r}')
+
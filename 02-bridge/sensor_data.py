@@ -0,0 +1,15 @@
+"""Parsed MQTT readings, as handed from the topic parser to the InfluxDB writer"""
+
+from typing import NamedTuple
+
+
+class SensorData(NamedTuple):
+    location: str
+    measurement: str
+    value: float
+    value_str: str
+
+class SensorDataJson(NamedTuple):
+    location: str
+    measurement: str
+    value_dict: dict
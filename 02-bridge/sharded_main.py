@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Multi-process MQTT to InfluxDB Bridge
+
+Runs `SHARD_WORKERS` copies of the `main.py` bridge in separate processes so
+ingest scales with the number of cores. Messages are split between them in
+one of two ways:
+
+- `hash`: every worker subscribes to everything and only handles the
+  series that hash to its own index, so the state the bridge keeps per
+  series (filter deadbands and windows, per `(location, measurement)`) and
+  per JSON measurement (learned field types) lives in exactly one worker
+- `shared`: every worker subscribes through an MQTT shared subscription
+  (`$share/<SHARD_GROUP>/home/+/+`) and the broker load-balances messages,
+  so any worker can see any series. Cheaper on the network, but refused
+  when `FILTER_RULES` are set, as each worker would filter and aggregate
+  its own share of a series
+
+A supervisor restarts workers that die or stop reporting, and periodically
+prints their aggregated throughput counters.
+
+"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import zlib
+
+import main as bridge
+import topic_router
+
+SHARD_WORKERS = os.cpu_count() or 1
+SHARD_MODE = 'hash'  # [hash|shared]
+SHARD_GROUP = 'mqttbridge'
+SHARD_REPORT_INTERVAL = 1  # seconds between worker counter updates
+SHARD_STATS_INTERVAL = 60  # seconds between supervisor reports
+SHARD_HEARTBEAT_TIMEOUT = 30  # seconds without a counter update before a worker is restarted
+
+# per-worker slots in the shared counter array
+HEARTBEAT, MESSAGES, POINTS_WRITTEN, POINTS_FAILED, QUEUE_DEPTH = range(5)
+COUNTERS = ('heartbeat', 'messages', 'points_written', 'points_failed', 'queue_depth')
+
+log = logging.getLogger(__name__)
+
+
+def topic_shard(topic, shards):
+    """Deterministic across processes, unlike hash() on str."""
+    return zlib.crc32(topic.encode('utf-8')) % shards
+
+
+def shard_key(topic):
+    """
+    The series a topic belongs to: `location/measurement`, or just the
+    measurement for JSON topics, whose field types are shared across locations.
+    """
+    route = bridge.router.route(topic)
+    if route is None:
+        return topic
+    if route.kind == topic_router.JSON:
+        return route.measurement
+    return f'{route.location}/{route.measurement}'
+
+
+def check_shard_mode():
+    if SHARD_MODE not in ('hash', 'shared'):
+        raise ValueError(f'unknown SHARD_MODE {SHARD_MODE!r}, expected hash or shared')
+    if SHARD_MODE == 'shared' and bridge.FILTER_RULES:
+        raise ValueError("FILTER_RULES keep per-series state, which needs SHARD_MODE = 'hash'")
+
+
+def _report_counters(counters, index):
+    base = index * len(COUNTERS)
+    while True:
+        counters[base + MESSAGES] = bridge.messages_received.value
+        counters[base + POINTS_WRITTEN] = bridge.points_written.value
+        counters[base + POINTS_FAILED] = bridge.points_failed.value
+        counters[base + QUEUE_DEPTH] = bridge.message_queue.depth() if bridge.message_queue is not None else 0
+        counters[base + HEARTBEAT] = time.time()
+        time.sleep(SHARD_REPORT_INTERVAL)
+
+
+def _run_worker(index, counters):
+    # let the bridge flush its buffers when the supervisor terminates us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    topic_prefix = ''
+    topic_filter = None
+    if SHARD_MODE == 'shared':
+        topic_prefix = f'$share/{SHARD_GROUP}/'
+    else:
+        topic_filter = functools.lru_cache(maxsize=bridge.MQTT_TOPIC_CACHE_SIZE)(
+            lambda topic: topic_shard(shard_key(topic), SHARD_WORKERS) == index
+        )
+
+    threading.Thread(target=_report_counters, args=(counters, index), name='shard-counters', daemon=True).start()
+    bridge.main(
+        client_id=f'{bridge.MQTT_CLIENT_ID}-{index}',
+        topic_prefix=topic_prefix,
+        topic_filter=topic_filter,
+        spool_directory=os.path.join(bridge.SPOOL_DIRECTORY, f'shard-{index}'),
+        spill_path=f'{bridge.PIPELINE_SPILL_PATH}.{index}',
+        # shard i serves its metrics one port above shard i-1
+        metrics_port=bridge.METRICS_PORT + 1 + index if bridge.METRICS_PORT is not None else None,
+    )
+
+
+class Supervisor:
+    def __init__(self, workers):
+        self.workers = workers
+        self.counters = multiprocessing.Array('d', workers * len(COUNTERS), lock=False)
+        self.processes = [None] * workers
+
+    def start_worker(self, index):
+        base = index * len(COUNTERS)
+        self.counters[base + HEARTBEAT] = time.time()
+        process = multiprocessing.Process(target=_run_worker, args=(index, self.counters), name=f'bridge-shard-{index}')
+        process.start()
+        self.processes[index] = process
+
+    def worker_counters(self, index):
+        base = index * len(COUNTERS)
+        return dict(zip(COUNTERS, self.counters[base:base + len(COUNTERS)]))
+
+    def check_workers(self):
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            heartbeat_age = now - self.worker_counters(index)['heartbeat']
+            if not process.is_alive():
+                log.warning(f'shard {index} exited with code {process.exitcode}, restarting')
+            elif heartbeat_age > SHARD_HEARTBEAT_TIMEOUT:
+                log.warning(f'shard {index} has not reported for {heartbeat_age:.0f}s, restarting')
+                process.terminate()
+                process.join()
+            else:
+                continue
+            self.start_worker(index)
+
+    def report(self, previous, elapsed):
+        """Print rates since the previous report; returns the counters to pass in next time."""
+        current = [self.worker_counters(index) for index in range(self.workers)]
+        rates = {}
+        for counter in ('messages', 'points_written', 'points_failed'):
+            delta = 0
+            for index, counters in enumerate(current):
+                last = previous[index][counter] if previous else 0
+                # a restarted worker starts counting from zero again
+                delta += counters[counter] - last if counters[counter] >= last else counters[counter]
+            rates[counter] = delta / elapsed
+        queue_depth = sum(counters['queue_depth'] for counters in current)
+        log.info(
+            f'{self.workers} shards: {rates["messages"]:.1f} msg/s, {rates["points_written"]:.1f} points/s written, '
+            f'{rates["points_failed"]:.1f} points/s failed, queue depth {queue_depth:.0f}'
+        )
+        return current
+
+    def run(self):
+        check_shard_mode()
+        for index in range(self.workers):
+            self.start_worker(index)
+        previous = None
+        last_report = time.monotonic()
+        try:
+            while True:
+                time.sleep(SHARD_REPORT_INTERVAL)
+                self.check_workers()
+                if time.monotonic() - last_report >= SHARD_STATS_INTERVAL:
+                    now = time.monotonic()
+                    previous = self.report(previous, now - last_report)
+                    last_report = now
+        finally:
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join()
+
+
+if __name__ == '__main__':
+    bridge.configure_logging()
+    log.info(f'MQTT to InfluxDB bridge ({SHARD_WORKERS} {SHARD_MODE} shards)')
+    Supervisor(SHARD_WORKERS).run()
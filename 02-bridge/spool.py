@@ -0,0 +1,189 @@
+"""Disk-backed write-ahead spool for batches InfluxDB did not accept
+
+Failed batches are appended, as line protocol, to append-only segment files
+in a local directory. Appends go through a buffered file and are fsync'ed at
+most every `fsync_interval` seconds, so a burst of failures costs sequential
+writes and not one fsync each. Once a segment reaches `segment_size` bytes a
+new one is started.
+
+`SpoolReplayer` drains the segments oldest first, in bulk writes of
+`batch_size` lines, capped at `max_points_per_second` so catch-up does not
+starve live ingest. A segment is deleted once it is fully replayed. A batch
+InfluxDB rejects outright (`RejectedBatch`) is logged and skipped, so it
+cannot hold back the segments behind it; anything else is retried. Every
+point carries its own timestamp, so replaying a segment twice after a crash
+just overwrites the same points.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from batch_writer import RejectedBatch
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.lp'
+
+log = logging.getLogger(__name__)
+
+
+class Spool:
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sealed = self._existing_segments()
+        self._next_sequence = self._sequence(self._sealed[-1]) + 1 if self._sealed else 1
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+        self._last_fsync = time.monotonic()
+
+    def _existing_segments(self):
+        names = [
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        ]
+        return [os.path.join(self.directory, name) for name in sorted(names, key=self._sequence)]
+
+    @staticmethod
+    def _sequence(path):
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def __len__(self):
+        """Number of segments waiting to be replayed, including the active one."""
+        with self._lock:
+            return len(self._sealed) + (self._active is not None)
+
+    def append(self, lines):
+        """Append a batch of newline-terminated line protocol (bytes)."""
+        with self._lock:
+            if self._active is None:
+                self._open_segment()
+            self._active.write(lines)
+            self._active_size += len(lines)
+            if self._active_size >= self.segment_size:
+                self._seal()
+            elif time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+
+    def sync(self):
+        """fsync the active segment, if it has unsynced data."""
+        with self._lock:
+            if self._active is not None:
+                self._fsync()
+
+    def take_oldest(self):
+        """Return the path of the oldest segment, sealing the active one if needed."""
+        with self._lock:
+            if not self._sealed and self._active is not None:
+                self._seal()
+            return self._sealed[0] if self._sealed else None
+
+    def remove(self, path):
+        with self._lock:
+            self._sealed.remove(path)
+        os.remove(path)
+
+    def close(self):
+        with self._lock:
+            if self._active is not None:
+                self._seal()
+
+    def _open_segment(self):
+        self._active_path = os.path.join(self.directory, f'{SEGMENT_PREFIX}{self._next_sequence:08d}{SEGMENT_SUFFIX}')
+        self._next_sequence += 1
+        self._active = open(self._active_path, 'ab', buffering=1024 * 1024)
+        self._active_size = 0
+
+    def _fsync(self):
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._last_fsync = time.monotonic()
+
+    def _seal(self):
+        self._fsync()
+        self._active.close()
+        self._sealed.append(self._active_path)
+        self._active = None
+        self._active_path = None
+
+
+def read_batches(path, batch_size):
+    """Yield `(line_count, bytes)` chunks of at most `batch_size` lines from a segment."""
+    with open(path, 'rb', buffering=1024 * 1024) as f:
+        lines = []
+        for line in f:
+            if not line.endswith(b'\n'):
+                # torn write from a crash, the rest of this line never made it to disk
+                break
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield len(lines), b''.join(lines)
+                lines = []
+        if lines:
+            yield len(lines), b''.join(lines)
+
+
+class SpoolReplayer:
+    def __init__(self, spool, write_lines, batch_size=5000, max_points_per_second=20000, retry_interval=10.0):
+        """`write_lines` is called with a bytes body of newline-terminated line protocol."""
+        self.spool = spool
+        self._write_lines = write_lines
+        self.batch_size = batch_size
+        self.max_points_per_second = max_points_per_second
+        self.retry_interval = retry_interval
+
+        self.replayed_points = 0
+        self.rejected_points = 0
+        self.errors = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            path = None
+            try:
+                self.spool.sync()
+                path = self.spool.take_oldest()
+                if path is None:
+                    self._stopped.wait(self.retry_interval)
+                    continue
+                self._replay(path)
+                if not self._stopped.is_set():
+                    self.spool.remove(path)
+                    log.info(f'replayed spool segment {path}, {len(self.spool)} left')
+            except Exception as e:
+                self.errors += 1
+                log.warning(f'spool replay of {path} failed, retrying in {self.retry_interval}s: {e!r}')
+                self._stopped.wait(self.retry_interval)
+
+    def _replay(self, path):
+        for count, body in read_batches(path, self.batch_size):
+            if self._stopped.is_set():
+                return
+            started = time.monotonic()
+            try:
+                self._write_lines(body)
+            except RejectedBatch as e:
+                log.warning(f'influxdb rejected {count} points from {path}, dropping them: {e}')
+                self.rejected_points += count
+            else:
+                self.replayed_points += count
+            # stay under the configured rate so live writes keep their share of InfluxDB
+            min_duration = count / self.max_points_per_second
+            elapsed = time.monotonic() - started
+            if elapsed < min_duration:
+                self._stopped.wait(min_duration - elapsed)
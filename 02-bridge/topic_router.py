@@ -0,0 +1,116 @@
+"""Compiled MQTT topic router
+
+Maps an MQTT topic to a `Route` (location, measurement and how to decode the
+payload) using a list of `TopicRule`s. Every distinct topic is matched
+against the rules once; the result is kept in a bounded LRU cache, so on the
+hot path routing a topic is a single dict lookup.
+
+A rule pattern is an MQTT topic filter whose levels can be literals, `+`,
+a trailing `#`, or the placeholders `{location}` and `{measurement}`, e.g.
+
+    TopicRule('home/{location}/{measurement}')
+    TopicRule('tele/{location}/SENSOR', measurement='tasmota_json', kind=JSON)
+
+"""
+
+import functools
+from typing import NamedTuple
+
+NUMERIC = 'numeric'  # float, falling back to a string value
+STRING = 'string'
+JSON = 'json'
+IGNORE = 'ignore'
+
+LOCATION = '{location}'
+MEASUREMENT = '{measurement}'
+
+
+class Route(NamedTuple):
+    location: str
+    measurement: str
+    kind: str
+
+
+def default_kind(measurement):
+    """How the bridge has always decoded `home/+/+` topics."""
+    if measurement == 'status':
+        return IGNORE
+    if measurement == 'system_info' or measurement.endswith('json'):
+        return JSON
+    return NUMERIC
+
+
+class TopicRule:
+    def __init__(self, pattern, location=None, measurement=None, kind=None):
+        """`location`/`measurement` fix the value when the pattern has no placeholder for it;
+        `kind` overrides `default_kind`."""
+        self.pattern = pattern
+        self.levels = pattern.split('/')
+        if '#' in self.levels[:-1]:
+            raise ValueError(f'{pattern!r}: # is only allowed as the last level')
+        if (LOCATION in self.levels) == (location is not None):
+            raise ValueError(f'{pattern!r}: needs exactly one of a {LOCATION} level or a fixed location')
+        if (MEASUREMENT in self.levels) == (measurement is not None):
+            raise ValueError(f'{pattern!r}: needs exactly one of a {MEASUREMENT} level or a fixed measurement')
+        self.location = location
+        self.measurement = measurement
+        self.kind = kind
+
+    @property
+    def subscription(self):
+        """The MQTT topic filter to subscribe to for this rule."""
+        return '/'.join('+' if level in (LOCATION, MEASUREMENT) else level for level in self.levels)
+
+    def match(self, topic_levels):
+        """
+        The `Route` for a topic split into its levels, or None if it does not match.
+        A `{location}` or `{measurement}` level never matches an empty topic level,
+        which would make an invalid InfluxDB point.
+
+        >>> TopicRule('home/{location}/{measurement}').match('home/bme280/temperature'.split('/'))
+        Route(location='bme280', measurement='temperature', kind='numeric')
+        >>> TopicRule('home/{location}/{measurement}').match('home/loc/'.split('/')) is None
+        True
+        >>> TopicRule('home/{location}/{measurement}').match('home//temperature'.split('/')) is None
+        True
+        """
+        location = self.location
+        measurement = self.measurement
+        for i, level in enumerate(self.levels):
+            if level == '#':
+                break
+            if i >= len(topic_levels):
+                return None
+            value = topic_levels[i]
+            if not value and level in (LOCATION, MEASUREMENT):
+                return None
+            if level == LOCATION:
+                location = value
+            elif level == MEASUREMENT:
+                measurement = value
+            elif level != '+' and level != value:
+                return None
+        else:
+            if len(topic_levels) != len(self.levels):
+                return None
+        kind = self.kind if self.kind is not None else default_kind(measurement)
+        return Route(location, measurement, kind)
+
+
+class TopicRouter:
+    def __init__(self, rules, cache_size=4096):
+        self.rules = list(rules)
+        self.route = functools.lru_cache(maxsize=cache_size)(self._route)
+
+    @property
+    def subscriptions(self):
+        return [rule.subscription for rule in self.rules]
+
+    def _route(self, topic):
+        """Return the `Route` of the first matching rule, or None."""
+        levels = topic.split('/')
+        for rule in self.rules:
+            route = rule.match(levels)
+            if route is not None:
+                return route
+        return None
@@ -0,0 +1,91 @@
+"""Decoding of the readings MiJia/LYWSD sensors broadcast in their advertisements
+
+Two formats are understood, both sent as 16 bit UUID service data (AD type 0x16):
+
+- Xiaomi MiBeacon (UUID 0xfe95), sent by the stock MJ_HT_V1, LYWSD02 and
+  LYWSD03MMC firmware. Each frame carries one object: the temperature,
+  the humidity, both, or the battery level. Encrypted frames are skipped.
+- the custom firmware for the LYWSD03MMC (UUID 0x181a), in both its
+  13 byte (atc1441) and 15 byte (pvvx) layouts, which carry temperature,
+  humidity and battery in every frame.
+
+"""
+
+import struct
+from typing import NamedTuple
+
+MIBEACON_UUID = 0xfe95
+CUSTOM_FIRMWARE_UUID = 0x181a
+
+MIBEACON_ENCRYPTED = 0x0008
+MIBEACON_HAS_MAC = 0x0010
+MIBEACON_HAS_CAPABILITY = 0x0020
+MIBEACON_HAS_OBJECT = 0x0040
+
+MIBEACON_TEMPERATURE = 0x1004
+MIBEACON_HUMIDITY = 0x1006
+MIBEACON_BATTERY = 0x100a
+MIBEACON_TEMPERATURE_HUMIDITY = 0x100d
+
+
+class Advertisement(NamedTuple):
+    counter: int  # frame counter, repeated frames carry the same one
+    temperature: float = None
+    humidity: float = None
+    battery: int = None
+
+
+def decode(service_data):
+    """Decode 16 bit UUID service data (UUID first, little endian), or return None if it holds no reading."""
+    if len(service_data) < 2:
+        return None
+    uuid = service_data[0] | service_data[1] << 8
+    if uuid == MIBEACON_UUID:
+        return decode_mibeacon(service_data[2:])
+    if uuid == CUSTOM_FIRMWARE_UUID:
+        return decode_custom_firmware(service_data[2:])
+    return None
+
+
+def decode_mibeacon(data):
+    if len(data) < 5:
+        return None
+    frame_control = data[0] | data[1] << 8
+    if frame_control & MIBEACON_ENCRYPTED or not frame_control & MIBEACON_HAS_OBJECT:
+        return None
+    # frame control (2 bytes), product id (2), frame counter (1), then the optional MAC and capability
+    counter = data[4]
+    offset = 5
+    if frame_control & MIBEACON_HAS_MAC:
+        offset += 6
+    if frame_control & MIBEACON_HAS_CAPABILITY:
+        offset += 1
+    if len(data) < offset + 3:
+        return None
+    object_type, length = struct.unpack_from('<HB', data, offset)
+    value = data[offset + 3:offset + 3 + length]
+    if len(value) < length:
+        return None
+
+    if object_type == MIBEACON_TEMPERATURE and length == 2:
+        return Advertisement(counter, temperature=struct.unpack('<h', value)[0] / 10)
+    if object_type == MIBEACON_HUMIDITY and length == 2:
+        return Advertisement(counter, humidity=struct.unpack('<H', value)[0] / 10)
+    if object_type == MIBEACON_TEMPERATURE_HUMIDITY and length == 4:
+        temperature, humidity = struct.unpack('<hH', value)
+        return Advertisement(counter, temperature=temperature / 10, humidity=humidity / 10)
+    if object_type == MIBEACON_BATTERY and length == 1:
+        return Advertisement(counter, battery=value[0])
+    return None
+
+
+def decode_custom_firmware(data):
+    if len(data) == 13:
+        # MAC (6 bytes), temperature (0.1 C), humidity (%), battery (%), battery (mV), counter; big endian
+        temperature, humidity, battery, _, counter = struct.unpack_from('>hBBHB', data, 6)
+        return Advertisement(counter, temperature / 10, float(humidity), battery)
+    if len(data) == 15:
+        # MAC (6 bytes), temperature (0.01 C), humidity (0.01 %), battery (mV), battery (%), counter, flags
+        temperature, humidity, _, battery, counter = struct.unpack_from('<hHHBB', data, 6)
+        return Advertisement(counter, temperature / 100, humidity / 100, battery)
+    return None
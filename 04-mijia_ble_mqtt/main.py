@@ -2,25 +2,39 @@
 
 """MiJia GATT to MQTT"""
 
+import heapq
 import re
+import threading
 import time
 
 import paho.mqtt.client as mqtt
 from bluepy import btle
 
-MQTT_TOPIC_HUMIDITY = 'home/mijia/humidity'
-MQTT_TOPIC_TEMPERATURE = 'home/mijia/temperature'
-MQTT_TOPIC_BATTERY = 'home/mijia/battery'
+import advertisement
+from publish_buffer import PublishBuffer
+
+MQTT_TOPIC_FORMAT = 'home/{device}/{measurement}'  # measurement is temperature, humidity or battery
 MQTT_TOPIC_STATE = 'home/mijia/status'
 
-MQTT_PUBLISH_DELAY = 60
+MQTT_PUBLISH_DELAY = 60  # seconds; in persistent mode 0 publishes every notification, otherwise their mean
 MQTT_CLIENT_ID = 'mijia'
 
+# Readings are buffered until the broker acknowledges them, so none are lost while it is unreachable
+MQTT_BUFFER_SIZE = 10000  # readings kept in memory
+MQTT_BUFFER_OVERFLOW_PATH = '/var/tmp/mijia-buffer.log'  # readings beyond MQTT_BUFFER_SIZE, None to drop them
+MQTT_BUFFER_OVERFLOW_SIZE = 1000000  # readings
+MQTT_MAX_IN_FLIGHT = 10  # readings waiting for an acknowledgement
+MQTT_TIMESTAMPED_PAYLOADS = True  # publish {"t": <unix seconds>, "v": <value>} instead of the bare value
+
 MQTT_SERVER = 'homeserver'
 MQTT_USER = 'mqttuser'
 MQTT_PASSWORD = 'mqttpassword'
 
-MIJIA_BTLE_ADDRESS = '4c:65:a8:d7:fb:36'
+# Device name (used in the MQTT topics) -> BLE address
+MIJIA_DEVICES = {
+    'mijia': '4c:65:a8:d7:fb:36',
+    # 'bedroom': '4c:65:a8:d7:fb:37',
+}
 
 MIJIA_BATTERY_SERVICE_UUID = btle.UUID('180f')
 MIJIA_BATTERY_CHARACTERISTIC_UUID = btle.UUID('2a19')
@@ -32,103 +46,325 @@ MIJIA_DATA_CHARACTERISTIC_HANDLE = 0x0010
 BTLE_SUBSCRIBE_VALUE = bytes([0x01, 0x00])
 BTLE_UNSUBSCRIBE_VALUE = bytes([0x00, 0x00])
 
-battery = None
-temperature = None
-humidity = None
+# Stay connected with notifications subscribed instead of reconnecting for every reading
+MIJIA_PERSISTENT_CONNECTION = True
+MIJIA_BATTERY_READ_INTERVAL = 3 * 60 * 60  # seconds
+MIJIA_RECONNECT_MIN_DELAY = 1  # seconds, doubled after every failed connection
+MIJIA_RECONNECT_MAX_DELAY = 300  # seconds
+# Connections are set up one at a time over the adapter, so these cap how long an absent sensor holds it up
+MIJIA_CONNECT_TIMEOUT = 10  # seconds
+MIJIA_READ_TIMEOUT = 10  # seconds to wait for a notification when polling
+
+# Only listen to the readings the sensors broadcast in their advertisements, without ever connecting.
+# The latest reading of every sensor heard from is published every MQTT_PUBLISH_DELAY seconds.
+MIJIA_SCAN_ADVERTISEMENTS = False
+MIJIA_SCAN_PASSIVE = True  # do not send scan requests
+
+SENSOR_DATA_PATTERN = re.compile(r'T=([\d.-]+) H=([\d.-]+)')
+
+adapter_lock = threading.Lock()
 
 
 def on_connect(client, userdata, flags, rc):
     client.publish(MQTT_TOPIC_STATE, 'connected', 1, True)
+    if rc == 0:
+        userdata.on_connect()
+
+
+def on_disconnect(client, userdata, rc):
+    userdata.on_disconnect()
+
 
+def on_publish(client, userdata, mid):
+    userdata.on_publish(mid)
+
+
+class ReadingWindow:
+    """Temperature/humidity notifications received since the last publish."""
 
-class MyDelegate(btle.DefaultDelegate):
     def __init__(self):
+        self.count = 0
+        self.temperature_sum = 0.0
+        self.humidity_sum = 0.0
+
+    def add(self, temperature, humidity):
+        self.count += 1
+        self.temperature_sum += temperature
+        self.humidity_sum += humidity
+
+    def mean(self):
+        return self.temperature_sum / self.count, self.humidity_sum / self.count
+
+    def reset(self):
+        self.__init__()
+
+
+class Device:
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.battery = None
+        self.battery_read_time = None
+        self.window = ReadingWindow()
+        self.last_publish_time = time.time()
+        self.reconnect_delay = MIJIA_RECONNECT_MIN_DELAY
+        # latest advertised reading, when scanning
+        self.temperature = None
+        self.humidity = None
+        self.frame_counter = None
+        self.advertised = False
+
+    def topic(self, measurement):
+        return MQTT_TOPIC_FORMAT.format(device=self.name, measurement=measurement)
+
+    def battery_due(self):
+        return self.battery_read_time is None or time.time() - self.battery_read_time >= MIJIA_BATTERY_READ_INTERVAL
+
+    def connected(self):
+        self.reconnect_delay = MIJIA_RECONNECT_MIN_DELAY
+
+    def next_reconnect_delay(self):
+        """Delay before the next connection attempt, doubling it for the one after."""
+        delay = self.reconnect_delay
+        self.reconnect_delay = min(delay * 2, MIJIA_RECONNECT_MAX_DELAY)
+        return delay
+
+
+class NotificationDelegate(btle.DefaultDelegate):
+    def __init__(self, window):
         btle.DefaultDelegate.__init__(self)
+        self.window = window
 
     def handleNotification(self, cHandle, data):
-        fetch_sensor_data(bytearray(data).decode('utf-8'))
+        reading = parse_sensor_data(bytearray(data).decode('utf-8', errors='replace'))
+        if reading is not None:
+            self.window.add(*reading)
+
+
+class AdvertisementDelegate(btle.DefaultDelegate):
+    def __init__(self, devices):
+        btle.DefaultDelegate.__init__(self)
+        self.devices = {device.address.lower(): device for device in devices}
+        self.duplicates = 0
+
+    def handleDiscovery(self, entry, isNewDev, isNewData):
+        device = self.devices.get(entry.addr)
+        if device is None or not isNewData:
+            return
+        service_data = entry.getValue(btle.ScanEntry.SERVICE_DATA_16B)
+        if service_data is None:
+            return
+        reading = advertisement.decode(service_data)
+        if reading is None:
+            return
+        # sensors repeat every frame a few times
+        if reading.counter == device.frame_counter:
+            self.duplicates += 1
+            return
+        device.frame_counter = reading.counter
+        if reading.temperature is not None:
+            device.temperature = reading.temperature
+        if reading.humidity is not None:
+            device.humidity = reading.humidity
+        if reading.battery is not None:
+            device.battery = reading.battery
+        device.advertised = True
 
 
 def main():
     mqttc = mqtt.Client(MQTT_CLIENT_ID)
+    publisher = PublishBuffer(
+        mqttc,
+        max_memory=MQTT_BUFFER_SIZE,
+        overflow_path=MQTT_BUFFER_OVERFLOW_PATH,
+        max_overflow=MQTT_BUFFER_OVERFLOW_SIZE,
+        max_in_flight=MQTT_MAX_IN_FLIGHT,
+        timestamped=MQTT_TIMESTAMPED_PAYLOADS,
+    )
+    mqttc.user_data_set(publisher)
     mqttc.username_pw_set(MQTT_USER, MQTT_PASSWORD)
     mqttc.will_set(MQTT_TOPIC_STATE, 'disconnected', 1, True)
     mqttc.on_connect = on_connect
+    mqttc.on_disconnect = on_disconnect
+    mqttc.on_publish = on_publish
 
-    mqttc.connect(MQTT_SERVER, 1883, 60)
+    publisher.start()
+    # connect in the background, readings are buffered until the broker is reachable
+    mqttc.connect_async(MQTT_SERVER, 1883, 60)
     mqttc.loop_start()
 
-    last_msg_time = time.time()
-
+    devices = [Device(name, address) for name, address in MIJIA_DEVICES.items()]
+    if MIJIA_SCAN_ADVERTISEMENTS:
+        run_scanning(publisher, devices)
+    elif MIJIA_PERSISTENT_CONNECTION:
+        threads = [
+            threading.Thread(target=run_persistent, args=(publisher, device), name=device.name, daemon=True)
+            for device in devices
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        run_polling(publisher, devices)
+
+
+def connect(device):
+    """Connect to `device`, with one connection attempt on the adapter at a time."""
+    print(f'Connecting to {device.name} ({device.address})')
+    with adapter_lock:
+        dev = btle.Peripheral(device.address, timeout=MIJIA_CONNECT_TIMEOUT)
+    dev.setDelegate(NotificationDelegate(device.window))
+    return dev
+
+
+def disconnect(dev):
+    if dev is None:
+        return
+    try:
+        dev.disconnect()
+    except (btle.BTLEException, IOError):
+        pass
+
+
+def run_polling(publisher, devices):
+    """
+    Connect, read one notification and disconnect again for every reading, polling the
+    device that is due soonest first. Devices that cannot be reached are retried with
+    exponential backoff, so they do not take adapter time from the others.
+    """
+    schedule = [(0.0, index, device) for index, device in enumerate(devices)]
     while True:
+        due, index, device = heapq.heappop(schedule)
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        if poll(publisher, device):
+            device.connected()
+            next_due = max(due + MQTT_PUBLISH_DELAY, time.time())
+        else:
+            delay = device.next_reconnect_delay()
+            print(f'{device.name}: retrying in {delay}s')
+            next_due = time.time() + delay
+        heapq.heappush(schedule, (next_due, index, device))
+
+
+def poll(publisher, device):
+    """Read and publish one reading of `device`; returns False if it could not be read."""
+    dev = None
+    try:
+        dev = connect(device)
+        if device.battery_due():
+            fetch_battery_level(dev, device)
+        dev.writeCharacteristic(MIJIA_DATA_CHARACTERISTIC_HANDLE, BTLE_SUBSCRIBE_VALUE, True)
+        deadline = time.time() + MIJIA_READ_TIMEOUT
+        while not device.window.count and time.time() < deadline:
+            dev.waitForNotifications(1.0)
+        if device.window.count:
+            dev.writeCharacteristic(MIJIA_DATA_CHARACTERISTIC_HANDLE, BTLE_UNSUBSCRIBE_VALUE, True)
+    except (btle.BTLEException, IOError) as e:
+        print(f'{device.name}: disconnected ({e})')
+    except Exception as e:
+        print(f'{device.name}: unexpected error ({e!r})')
+    finally:
+        disconnect(dev)
+
+    if not device.window.count:
+        return False
+    publish_sensor_data(publisher, device, *device.window.mean())
+    device.window.reset()
+    return True
+
+
+def run_persistent(publisher, device):
+    """
+    Keep `device` connected with notifications subscribed, and publish as they arrive
+    (or their mean every MQTT_PUBLISH_DELAY seconds). The battery is read every
+    MIJIA_BATTERY_READ_INTERVAL seconds, and lost connections are retried with exponential backoff.
+    """
+    while True:
+        dev = None
         try:
-            print('Connecting to ' + MIJIA_BTLE_ADDRESS)
-            dev = btle.Peripheral(MIJIA_BTLE_ADDRESS)
-            print('Set delegate')
-            dev.setDelegate(MyDelegate())
-
-            # Get battery level
-            if battery is None:
-                fetch_battery_level(dev)
-                print('Battery level: ' + str(battery))
-
-            # Subscribe to data characteristic
-            if temperature is None or humidity is None:
-                dev.writeCharacteristic(MIJIA_DATA_CHARACTERISTIC_HANDLE, BTLE_SUBSCRIBE_VALUE, True)
-                while True:
-                    if dev.waitForNotifications(1.0):
-                        print('Temperature: ' + temperature)
-                        print('Humidity: ' + humidity)
-                        dev.writeCharacteristic(MIJIA_DATA_CHARACTERISTIC_HANDLE, BTLE_UNSUBSCRIBE_VALUE, True)
-                        dev.disconnect()
-                        break
-
-        except (btle.BTLEDisconnectError, IOError):
-            print("Disconnected :)")
-
-        if battery is not None and temperature is not None and humidity is not None:
-            delay_gap = time.time() - last_msg_time
-            if delay_gap < MQTT_PUBLISH_DELAY:
-                time.sleep(MQTT_PUBLISH_DELAY - delay_gap)
-
-            publish_sensor_data(mqttc)
-            last_msg_time = time.time()
-            reset_variables()
-
-
-def reset_variables():
-    global battery
-    global temperature
-    global humidity
-
-    battery = None
-    temperature = None
-    humidity = None
-
-
-def fetch_battery_level(dev):
-    global battery
-
+            dev = connect(device)
+            dev.writeCharacteristic(MIJIA_DATA_CHARACTERISTIC_HANDLE, BTLE_SUBSCRIBE_VALUE, True)
+            print(f'{device.name}: subscribed, streaming notifications')
+            device.connected()
+
+            while True:
+                if device.battery_due():
+                    fetch_battery_level(dev, device)
+                dev.waitForNotifications(1.0)
+                if device.window.count and time.time() - device.last_publish_time >= MQTT_PUBLISH_DELAY:
+                    publish_sensor_data(publisher, device, *device.window.mean())
+                    device.window.reset()
+                    device.last_publish_time = time.time()
+
+        except (btle.BTLEException, IOError) as e:
+            print(f'{device.name}: disconnected ({e}), reconnecting in {device.reconnect_delay}s')
+        except Exception as e:
+            # anything else would end this device's thread without a trace
+            print(f'{device.name}: unexpected error ({e!r}), reconnecting in {device.reconnect_delay}s')
+        finally:
+            disconnect(dev)
+
+        time.sleep(device.next_reconnect_delay())
+
+
+def run_scanning(publisher, devices):
+    """Scan continuously and publish the readings advertised by all devices in one batch per MQTT_PUBLISH_DELAY."""
+    delegate = AdvertisementDelegate(devices)
+    restart_delay = MIJIA_RECONNECT_MIN_DELAY
+    while True:
+        scanner = btle.Scanner().withDelegate(delegate)
+        try:
+            scanner.start(passive=MIJIA_SCAN_PASSIVE)
+            print(f'Scanning for {len(devices)} devices')
+            restart_delay = MIJIA_RECONNECT_MIN_DELAY
+            while True:
+                scanner.process(MQTT_PUBLISH_DELAY)
+                # bluepy keeps every device it ever saw, only the changes since the last round matter
+                scanner.clear()
+                advertised = [device for device in devices if device.advertised]
+                for device in advertised:
+                    publish_sensor_data(publisher, device, device.temperature, device.humidity)
+                    device.advertised = False
+                print(f'Published {len(advertised)} of {len(devices)} devices, {delegate.duplicates} repeated frames')
+        except (btle.BTLEException, IOError) as e:
+            print(f'Scan failed ({e}), restarting in {restart_delay}s')
+        finally:
+            try:
+                scanner.stop()
+            except (btle.BTLEException, IOError):
+                pass
+        time.sleep(restart_delay)
+        restart_delay = min(restart_delay * 2, MIJIA_RECONNECT_MAX_DELAY)
+
+
+def fetch_battery_level(dev, device):
     battery_service = dev.getServiceByUUID(MIJIA_BATTERY_SERVICE_UUID)
     battery_characteristic = battery_service.getCharacteristics(MIJIA_BATTERY_CHARACTERISTIC_UUID)[0]
-    battery = ord(battery_characteristic.read())
+    device.battery = ord(battery_characteristic.read())
+    device.battery_read_time = time.time()
+    print(f'{device.name}: battery level {device.battery}')
 
 
-def fetch_sensor_data(temp_hum):
-    global temperature
-    global humidity
-
-    pattern = re.compile('T=([\d.-]+) H=([\d.-]+)')
-    match = re.match(pattern, temp_hum)
+def parse_sensor_data(temp_hum):
+    """`'T=21.5 H=45.0'` -> `(21.5, 45.0)`, or None for anything else."""
+    match = re.match(SENSOR_DATA_PATTERN, temp_hum)
     if match:
-        temperature = match.group(1)
-        humidity = match.group(2)
-
-
-def publish_sensor_data(mqttc):
-    mqttc.publish(MQTT_TOPIC_TEMPERATURE, temperature, 1, True)
-    mqttc.publish(MQTT_TOPIC_HUMIDITY, humidity, 1, True)
-    mqttc.publish(MQTT_TOPIC_BATTERY, battery, 1, True)
+        return float(match.group(1)), float(match.group(2))
+    return None
+
+
+def publish_sensor_data(publisher, device, temperature, humidity):
+    sample_time = time.time()
+    if temperature is not None:
+        publisher.add(device.topic('temperature'), round(temperature, 1), sample_time)
+    if humidity is not None:
+        publisher.add(device.topic('humidity'), round(humidity, 1), sample_time)
+    if device.battery is not None:
+        publisher.add(device.topic('battery'), device.battery, sample_time)
 
 
 if __name__ == '__main__':
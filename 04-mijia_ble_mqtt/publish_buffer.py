@@ -0,0 +1,157 @@
+"""Ordered, bounded buffer for readings published over MQTT
+
+Readings are published with QoS 1 in the order they were taken, with at most
+`max_in_flight` of them waiting for the broker's acknowledgement, so a slow
+or restarting broker never blocks the sensor loop. A reading is handed to
+the MQTT client once; from then on the client owns it and resends it after
+a reconnect until the broker acknowledges it. While the broker is
+unreachable at most `max_in_flight` readings are handed over and the rest
+pile up here, in memory, up to `max_memory`, then in an overflow file, up to
+`max_overflow`, and newer readings are dropped after that. The overflow file
+is picked up again after a restart.
+
+With `timestamped` set, each payload carries the time the reading was taken,
+as `{"t": <unix seconds>, "v": <value>}`, so the bridge stores backfilled
+readings at the right time, and a reading that is published twice around a
+reconnect just overwrites the same point.
+
+All the bookkeeping happens on one thread, fed through a queue by `add` and
+the MQTT client callbacks, so none of them ever waits on the others.
+
+"""
+
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+READING = 'reading'
+ACK = 'ack'
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+
+
+class PublishBuffer:
+    def __init__(self, mqttc, max_memory=10000, overflow_path=None, max_overflow=1000000, max_in_flight=10,
+                 timestamped=True, retain=True):
+        self._mqttc = mqttc
+        self.max_memory = max_memory
+        self.overflow_path = overflow_path
+        self.max_overflow = max_overflow
+        self.max_in_flight = max_in_flight
+        self.timestamped = timestamped
+        self.retain = retain
+
+        self._events = queue.SimpleQueue()
+        self._pending = collections.deque()
+        self._in_flight = {}
+        self._connected = False
+        self._overflow_offset = 0
+        self._overflow_count = self._count_overflow()
+        self._thread = threading.Thread(target=self._run, name='publish-buffer', daemon=True)
+
+        self.published = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread.start()
+
+    def add(self, topic, value, sample_time=None):
+        """Queue `value` for `topic`, taken at `sample_time` (unix seconds, now by default)."""
+        if self.timestamped:
+            if sample_time is None:
+                sample_time = time.time()
+            payload = json.dumps({'t': round(sample_time, 3), 'v': value}, separators=(',', ':'))
+        else:
+            payload = str(value)
+        self._events.put((READING, topic, payload))
+
+    # MQTT client callbacks
+    def on_connect(self):
+        self._events.put((CONNECTED,))
+
+    def on_disconnect(self):
+        self._events.put((DISCONNECTED,))
+
+    def on_publish(self, mid):
+        self._events.put((ACK, mid))
+
+    def __len__(self):
+        """Readings not acknowledged yet (approximate, read from another thread)."""
+        return len(self._pending) + len(self._in_flight) + self._overflow_count
+
+    def _run(self):
+        while True:
+            self._handle(self._events.get())
+            self._flush()
+
+    def _handle(self, event):
+        kind = event[0]
+        if kind == READING:
+            self._store(event[1], event[2])
+        elif kind == ACK:
+            if self._in_flight.pop(event[1], None) is not None:
+                self.published += 1
+        elif kind == CONNECTED:
+            self._connected = True
+            if len(self) > 0:
+                print(f'Connected, publishing {len(self)} buffered readings')
+        elif kind == DISCONNECTED:
+            # readings in flight stay with the client, which resends them after reconnecting
+            self._connected = False
+
+    def _store(self, topic, payload):
+        # once readings overflow to disk, newer ones follow them there to keep the order
+        if not self._overflow_count and len(self._pending) < self.max_memory:
+            self._pending.append((topic, payload))
+        elif self.overflow_path is not None and self._overflow_count < self.max_overflow:
+            with open(self.overflow_path, 'a') as f:
+                f.write(f'{topic}\t{payload}\n')
+            self._overflow_count += 1
+        else:
+            self.dropped += 1
+
+    def _flush(self):
+        while self._connected and len(self._in_flight) < self.max_in_flight:
+            if not self._pending and self._overflow_count:
+                self._refill()
+            if not self._pending:
+                return
+            topic, payload = self._pending[0]
+            info = self._mqttc.publish(topic, payload, 1, self.retain)
+            if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                # with NO_CONN the client still queued the reading and sends it once it reconnects
+                self._pending.popleft()
+                self._in_flight[info.mid] = (topic, payload)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # wait for on_connect before trying again
+                self._connected = False
+                return
+
+    def _count_overflow(self):
+        if self.overflow_path is None or not os.path.exists(self.overflow_path):
+            return 0
+        with open(self.overflow_path, 'rb') as f:
+            return sum(1 for line in f if line.endswith(b'\n'))
+
+    def _refill(self):
+        """Move the oldest overflowed readings back into memory, deleting the file once it is drained."""
+        with open(self.overflow_path, 'rb') as f:
+            f.seek(self._overflow_offset)
+            while len(self._pending) < self.max_memory and self._overflow_count:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # torn write from a crash
+                    self._overflow_count = 0
+                    break
+                self._overflow_offset += len(line)
+                self._overflow_count -= 1
+                topic, _, payload = line[:-1].decode('utf-8').partition('\t')
+                self._pending.append((topic, payload))
+        if not self._overflow_count:
+            os.remove(self.overflow_path)
+            self._overflow_offset = 0
@@ -1,75 +1,144 @@
 import pandas as pd
-import numpy as np
-from datetime import datetime, timedelta
+import os
+import re
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from collections import namedtuple
 
+from html_tables import extract_tables
 
-def get_devices_info():
-    df = pd.read_html('http://192.168.1.254/cgi-bin/devices.ha')[0]
-    rows=[{}]
-    for i, k, v in df.itertuples():
-        if pd.isna(k):
-            rows.append({})
+ROUTER_URL = 'http://192.168.1.254/cgi-bin'
+CONNECT_TIMEOUT = 3 # seconds
+READ_TIMEOUT = 10 # seconds, per page
+
+LAN_STATISTICS_PAGE = 'lanstatistics.ha'
+DEVICES_PAGE = 'devices.ha'
+BROADBAND_STATISTICS_PAGE = 'broadbandstatistics.ha'
+PAGES = [LAN_STATISTICS_PAGE, DEVICES_PAGE, BROADBAND_STATISTICS_PAGE]
+
+# position of each table we use on its page, counting every <table> like pd.read_html did
+LAN_DEVICE_COUNT_TABLE = 1
+LAN_WIFI_CONFIG_TABLE = 5
+LAN_WIFI_PACKETS_TABLE = 6
+LAN_WIFI_CLIENTS_TABLE = 7
+LAN_ETHERNET_CLIENTS_TABLE = 8
+DEVICES_TABLE = 0
+BROADBAND_TABLE = 0
+BROADBAND_IPV6_STATUS_TABLE = 2
+BROADBAND_IPV4_TABLE = 3
+BROADBAND_IPV6_TABLE = 4
+
+# cell texts pd.read_html read as NaN
+NA_VALUES = {'', 'N/A', 'n/a', 'NA', '#N/A', 'NaN', 'nan', '-NaN', '-nan', 'NULL', 'null'}
+INTEGER_PATTERN = re.compile(r'-?(\d+|\d{1,3}(,\d{3})+)$')
+FLOAT_PATTERN = re.compile(r'-?(\d+\.\d*|\.\d+)$')
+ETHERNET_PORT_PATTERN = re.compile(r'Ethernet LAN-(\d+)$')
+
+
+def parse_cell(text):
+    if text in NA_VALUES:
+        return None
+    if INTEGER_PATTERN.match(text):
+        return int(text.replace(',', ''))
+    if FLOAT_PATTERN.match(text):
+        return float(text)
+    return text
+
+def get_tables(page, wanted):
+    tables = extract_tables(page, wanted)
+    return {key: [[parse_cell(cell) for cell in row] for row in rows] for key, rows in tables.items()}
+
+def records(table):
+    """Rows of a table whose first row is its header, as dicts."""
+    header, *rows = table
+    return [dict(zip(header, row)) for row in rows]
+
+def key_values(table, prefix=''):
+    """A two column label/value table as a dict."""
+    return {
+        f'{prefix}{row[0]}': row[1] for row in table
+        if len(row) > 1 and row[0] is not None and row[1] is not None
+    }
+
+
+def get_devices_info(table):
+    devices = [{}]
+    for row in table:
+        k, v = (row + [None, None])[:2]
+        if k is None:
+            devices.append({})
             continue
-        if ' / ' in k:
-            k1, k2 = k.split(' / ')
-            v1, v2 = v.split(' / ')
-            rows[-1][k1] = v1
-            rows[-1][k2] = v2
+        if isinstance(k, str) and ' / ' in k and isinstance(v, str) and ' / ' in v:
+            k1, k2 = k.split(' / ', 1)
+            v1, v2 = v.split(' / ', 1)
+            devices[-1][k1] = parse_cell(v1)
+            devices[-1][k2] = parse_cell(v2)
         else:
-            rows[-1][k] = v
-    devices = pd.DataFrame(rows)
-    devices['ethernet_port'] = np.nan
-    for i in [1,2,3,4]:
-        devices.loc[devices['Connection Type'] == f'Ethernet LAN-{i}', 'ethernet_port'] = f'Port {i}'
-    devices['merge index'] = devices['MAC Address']
-    devices.loc[~pd.isna(devices['ethernet_port']), 'merge index'] = devices['ethernet_port']
-    devices.set_index('MAC Address', drop=False)
+            devices[-1][k] = v
+    devices = [device for device in devices if device]
+    for device in devices:
+        port = ETHERNET_PORT_PATTERN.match(str(device.get('Connection Type')))
+        device['ethernet_port'] = f'Port {port.group(1)}' if port else None
+        device['merge index'] = device['ethernet_port'] or device.get('MAC Address')
     return devices
 
 
+def get_device_stats(wifi_clients, ethernet_clients, devices_info, timestamp):
+    # wifi clients are keyed by MAC address (first column), ethernet ports by their column header
+    stats = [(row[0], dict(zip(wifi_clients[0], row))) for row in wifi_clients[1:]]
+    ports = {port: {'ethernet_port': port} for port in ethernet_clients[0][1:] if port is not None}
+    for label, *values in ethernet_clients[1:]:
+        for port, value in zip(ethernet_clients[0][1:], values):
+            if port in ports:
+                ports[port][label] = value
+    stats += ports.items()
 
-def get_device_stats(dfs, devices_info, timestamp):
-    wifi_clients = dfs[7]
-    ethernet_clients = dfs[8]
-    wifi_clients = wifi_clients.set_index(wifi_clients.columns[0], drop=False)
-    ethernet_clients = ethernet_clients.set_index(ethernet_clients.columns[0]).transpose()
-    ethernet_clients['ethernet_port'] = ethernet_clients.index
-    df = pd.concat([wifi_clients, ethernet_clients])
-    df['timestamp'] = timestamp
-    
     # merge with devices info
-    m = (pd.merge(df, devices_info, left_index=True, right_on='merge index')
-            .drop(columns=['MAC Address_x', 'ethernet_port_x', 'merge index'])
-            .rename(columns={'MAC Address_y': 'MAC Address', 'ethernet_port_y': 'ethernet_port'})
-            .set_index('MAC Address', drop=False)
-    )
+    devices_by_key = {}
+    for device in devices_info:
+        devices_by_key.setdefault(device['merge index'], []).append(device)
+    rows = []
+    for key, device_stats in stats:
+        for device in devices_by_key.get(key, ()):
+            row = {**device_stats, **device, 'timestamp': timestamp}
+            del row['merge index']
+            rows.append(row)
+    m = pd.DataFrame(rows)
+    if 'MAC Address' in m:
+        m = m.set_index('MAC Address', drop=False)
     return m
 
-def get_wifi_radio_stats(dfs):
-    wifi_network_config = dfs[5].set_index('Unnamed: 0').dropna(how='all')
-    wifi_network_config = wifi_network_config.iloc[0:wifi_network_config.index.get_loc('Guest SSID')]
-    packet_counts = dfs[6].set_index(0).dropna(how='all')
-    packet_counts = packet_counts.rename(columns=packet_counts.iloc[0])
-    packet_counts = packet_counts[packet_counts.index.notna()]
-
-    m = pd.concat([wifi_network_config, packet_counts], axis='index')
-    m = m.dropna(how='all')
-    m = m.transpose()
-    m['Wi-Fi Radio'] = m.index
-    return m
+def get_wifi_radio_stats(wifi_network_config, packet_counts):
+    radios = {}
+    header, *rows = wifi_network_config
+    for label, *values in rows:
+        if label == 'Guest SSID':
+            break
+        if label is None or all(value is None for value in values):
+            continue
+        for radio, value in zip(header[1:], values):
+            radios.setdefault(radio, {})[label] = value
 
-def get_broadband_stats():
-    dfs2 = pd.read_html('http://192.168.1.254/cgi-bin/broadbandstatistics.ha')
-    m = pd.concat([
-        dfs2[3].set_index(0).rename(index=lambda idx: f'IPv4 {idx}'), # ipv4
-        dfs2[4].set_index(0).rename(index=lambda idx: f'IPv6 {idx}'), # ipv6
-        dfs2[2].set_index(0).rename(index=lambda idx: f'IPv6 {idx}'), # ipv6_status
-        dfs2[0].set_index(0), # broadband
-    ])
-    m = m[m.index.notna()]
-    m = m[m[1].notna()]
-    return m.transpose()
+    # no header cells here, the first non-empty row names the radios
+    packet_counts = [row for row in packet_counts if any(value is not None for value in row[1:])]
+    if packet_counts:
+        names = packet_counts[0][1:]
+        for label, *values in packet_counts:
+            if label is None:
+                continue
+            for radio, value in zip(names, values):
+                radios.setdefault(radio, {})[label] = value
+
+    return pd.DataFrame([{**stats, 'Wi-Fi Radio': radio} for radio, stats in radios.items()])
+
+def get_broadband_stats(tables):
+    return pd.DataFrame([{
+        **key_values(tables[BROADBAND_IPV4_TABLE], 'IPv4 '),
+        **key_values(tables[BROADBAND_IPV6_TABLE], 'IPv6 '),
+        **key_values(tables[BROADBAND_IPV6_STATUS_TABLE], 'IPv6 '),
+        **key_values(tables[BROADBAND_TABLE]),
+    }])
 
 NetworkInfo = namedtuple('NetworkInfo', [
     'timestamp',
@@ -79,45 +148,130 @@ NetworkInfo = namedtuple('NetworkInfo', [
     'broadband_stats',
 ])
 
-def query_router_stats():
-    timestamp = datetime.utcnow()
-    dfs = pd.read_html('http://192.168.1.254/cgi-bin/lanstatistics.ha')
-    devices_info = get_devices_info()
+def parse_router_pages(lan_page, devices_page, broadband_page, timestamp):
+    lan = get_tables(lan_page, [
+        LAN_DEVICE_COUNT_TABLE,
+        LAN_WIFI_CONFIG_TABLE,
+        LAN_WIFI_PACKETS_TABLE,
+        LAN_WIFI_CLIENTS_TABLE,
+        LAN_ETHERNET_CLIENTS_TABLE,
+    ])
+    devices_info = get_devices_info(get_tables(devices_page, [DEVICES_TABLE])[DEVICES_TABLE])
+    broadband = get_tables(broadband_page, [
+        BROADBAND_TABLE,
+        BROADBAND_IPV6_STATUS_TABLE,
+        BROADBAND_IPV4_TABLE,
+        BROADBAND_IPV6_TABLE,
+    ])
 
     return NetworkInfo(
         timestamp=timestamp,
-        device_stats=get_device_stats(dfs, devices_info, timestamp),
-        device_count_by_interface=dfs[1],
-        wifi_radio_stats=get_wifi_radio_stats(dfs),
-        broadband_stats=get_broadband_stats(),
+        device_stats=get_device_stats(
+            lan[LAN_WIFI_CLIENTS_TABLE], lan[LAN_ETHERNET_CLIENTS_TABLE], devices_info, timestamp),
+        device_count_by_interface=pd.DataFrame(records(lan[LAN_DEVICE_COUNT_TABLE])),
+        wifi_radio_stats=get_wifi_radio_stats(lan[LAN_WIFI_CONFIG_TABLE], lan[LAN_WIFI_PACKETS_TABLE]),
+        broadband_stats=get_broadband_stats(broadband),
+    )
+
+def make_session():
+    """Keep-alive session with a connection per page, so all of them can be fetched at once."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=len(PAGES))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+session = make_session()
+
+def fetch_page(name):
+    response = session.get(f'{ROUTER_URL}/{name}', timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    response.raise_for_status()
+    return response.text
+
+def fetch_pages():
+    """
+    Fetch all pages concurrently, returns `{name: html}` and the time the last one arrived,
+    which is used as the sample time of all of them.
+    """
+    with ThreadPoolExecutor(max_workers=len(PAGES)) as executor:
+        pages = dict(zip(PAGES, executor.map(fetch_page, PAGES)))
+    return pages, datetime.utcnow()
+
+def query_router_stats():
+    pages, timestamp = fetch_pages()
+    return parse_router_pages(
+        pages[LAN_STATISTICS_PAGE],
+        pages[DEVICES_PAGE],
+        pages[BROADBAND_STATISTICS_PAGE],
+        timestamp,
     )
 
-def compute_data_rates(stats1, stats2):
-    cols = [
-        'timestamp',
-        'Receive Bytes',
-        'Transmit Bytes', 
-        ]
-    merged = pd.merge(stats1[cols], stats2[cols], left_index=True, right_index=True)
-    merged['timedelta'] = (merged['timestamp_y'] - merged['timestamp_x'])/timedelta(seconds=1)
-    merged['receive_bps'] = (
-            (merged['Receive Bytes_y'].astype(int) - merged['Receive Bytes_x'].astype(int)) 
-            / merged['timedelta']
-        ).astype(int)
-    merged['transmit_bps'] = (
-            (merged['Transmit Bytes_y'].astype(int) - merged['Transmit Bytes_x'].astype(int)) 
-            / merged['timedelta']
-        ).astype(int)
-    merged = merged.drop(columns=[
-        'Receive Bytes_y',
-        'Receive Bytes_x',
-        'Transmit Bytes_y',
-        'Transmit Bytes_x',
-    ]).rename(columns={
-        'timestamp_x': 'begin_timestamp',
-        'timestamp_y': 'end_timestamp',
-    })
-    return merged
+# counter -> rate field written next to it, bytes are turned into bits per second
+RATE_COUNTERS = {
+    'Receive Bytes': 'receive_bps',
+    'Transmit Bytes': 'transmit_bps',
+    'Receive Packets': 'receive_pps',
+    'Transmit Packets': 'transmit_pps',
+}
+RATE_SCALE = {'Receive Bytes': 8, 'Transmit Bytes': 8}
+COUNTER_WRAP = 2 ** 32
+MAX_RATE_INTERVAL = 600 # seconds, older samples are forgotten rather than averaged over
+
+def counter_increase(previous, current):
+    """
+    Increase of a counter between two samples, assuming a 32 bit counter wrapped
+    if it went down by more than half its range, None if it was reset instead.
+    """
+    if current >= previous:
+        return current - previous
+    wrapped = current + COUNTER_WRAP - previous
+    if previous < COUNTER_WRAP and wrapped < COUNTER_WRAP // 2:
+        return wrapped
+    return None
+
+class DeviceRates:
+    """
+    Computes per-device rates at ingest time from consecutive polls, keeping only the
+    last sample of each device: MAC address -> (timestamp, counters). A device's
+    first sample, or the first one after a counter reset or a long gap, has no rates.
+    """
+
+    def __init__(self, max_interval=MAX_RATE_INTERVAL):
+        self.max_interval = max_interval
+        self._last = {}
+
+    def __len__(self):
+        return len(self._last)
+
+    def add_rates(self, device_stats, timestamp):
+        """`device_stats` with a column per `RATE_COUNTERS` rate (NaN where unknown)."""
+        counters = [counter for counter in RATE_COUNTERS if counter in device_stats]
+        if 'MAC Address' not in device_stats or not counters:
+            return device_stats
+        rates = {RATE_COUNTERS[counter]: [] for counter in counters}
+        samples = zip(device_stats['MAC Address'].tolist(), *(device_stats[c].tolist() for c in counters))
+        for mac, *values in samples:
+            values = {counter: None if pd.isna(value) else int(value) for counter, value in zip(counters, values)}
+            last = self._last.get(mac)
+            elapsed = (timestamp - last[0]).total_seconds() if last is not None else 0
+            for counter, value in values.items():
+                previous = last[1].get(counter) if last is not None else None
+                rate = None
+                if 0 < elapsed <= self.max_interval and value is not None and previous is not None:
+                    increase = counter_increase(previous, value)
+                    if increase is not None:
+                        rate = increase * RATE_SCALE.get(counter, 1) / elapsed
+                rates[RATE_COUNTERS[counter]].append(rate)
+            self._last[mac] = (timestamp, values)
+
+        # forget devices that went away
+        for mac in [mac for mac, (t, _) in self._last.items() if (timestamp - t).total_seconds() > self.max_interval]:
+            del self._last[mac]
+
+        return device_stats.assign(**{
+            field: pd.Series(values, index=device_stats.index, dtype='float64')
+            for field, values in rates.items()
+        })
 
 
 def capture_all_stats(outdir='stats'):
@@ -125,5 +279,14 @@ def capture_all_stats(outdir='stats'):
     for key in ['device_stats', 'device_count_by_interface', 'wifi_radio_stats', 'broadband_stats']:
         stats[key].to_csv(f'stats/{key}.csv')
 
+def capture_pages(outdir='pages'):
+    """Save the raw router pages, e.g. as fixtures for bench_html_tables.py"""
+    os.makedirs(outdir, exist_ok=True)
+    pages, _ = fetch_pages()
+    for name, html in pages.items():
+        with open(os.path.join(outdir, f'{name}.html'), 'w') as f:
+            f.write(html)
+
 if __name__ == '__main__':
+    capture_pages()
     capture_all_stats()
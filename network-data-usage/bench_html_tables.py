@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""Benchmark: parsing one poll's worth of router pages
+
+Compares `pd.read_html` on the three pages (what the collector used to do,
+needs lxml) with `html_tables.extract_tables` pulling only the tables the
+collector uses, and with the full `parse_router_pages`. Prints the time per
+poll, and the peak RSS of a fresh process that imports the collector's
+modules, builds the pages and parses them once, next to the RSS before
+parsing (which is mostly the pandas import). RSS also counts what lxml
+and numpy allocate outside Python's allocator.
+
+    $ python3 bench_html_tables.py [clients]      # synthetic pages, 30 wifi clients by default
+    $ python3 bench_html_tables.py pages/         # pages saved with arris_router_api.capture_pages()
+
+"""
+
+import io
+import os
+import sys
+import resource
+import subprocess
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import arris_router_api as api
+from html_tables import extract_tables
+from sample_pages import load_pages, sample_pages
+
+WANTED = {
+    api.LAN_STATISTICS_PAGE: [
+        api.LAN_DEVICE_COUNT_TABLE,
+        api.LAN_WIFI_CONFIG_TABLE,
+        api.LAN_WIFI_PACKETS_TABLE,
+        api.LAN_WIFI_CLIENTS_TABLE,
+        api.LAN_ETHERNET_CLIENTS_TABLE,
+    ],
+    api.DEVICES_PAGE: [api.DEVICES_TABLE],
+    api.BROADBAND_STATISTICS_PAGE: [
+        api.BROADBAND_TABLE,
+        api.BROADBAND_IPV6_STATUS_TABLE,
+        api.BROADBAND_IPV4_TABLE,
+        api.BROADBAND_IPV6_TABLE,
+    ],
+}
+
+
+def bench_read_html(pages):
+    for html in pages.values():
+        pd.read_html(io.StringIO(html))
+
+
+def bench_extract_tables(pages):
+    for name, html in pages.items():
+        extract_tables(html, WANTED[name])
+
+
+def bench_parse_router_pages(pages):
+    api.parse_router_pages(
+        pages[api.LAN_STATISTICS_PAGE],
+        pages[api.DEVICES_PAGE],
+        pages[api.BROADBAND_STATISTICS_PAGE],
+        datetime.utcnow(),
+    )
+
+
+def run(name, fn, pages, arg, repeat=20):
+    fn(pages)  # warm up
+    best = min(_timed(fn, pages) for _ in range(repeat))
+    rss = subprocess.run(
+        [sys.executable, __file__, '--rss', name, arg], check=True, capture_output=True, text=True,
+    ).stdout.split()
+    before, peak = (int(kb) / 1e3 for kb in rss)
+    print(f'{name:<28} {best * 1e3:>8.2f} ms/poll {peak:>8.1f} MB peak RSS ({before:.1f} MB before parsing)')
+
+
+def measure_rss(name, arg):
+    """Run in a fresh process: print the max RSS (kB) before and after parsing the pages once."""
+    pages = load_pages(arg) if os.path.isdir(arg) else sample_pages(int(arg))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    PATHS[name](pages)
+    print(before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def _timed(fn, pages):
+    started = time.perf_counter()
+    fn(pages)
+    return time.perf_counter() - started
+
+
+PATHS = {
+    'pd.read_html': bench_read_html,
+    'extract_tables': bench_extract_tables,
+    'parse_router_pages': bench_parse_router_pages,
+}
+
+
+def main():
+    if sys.argv[1:2] == ['--rss']:
+        measure_rss(sys.argv[2], sys.argv[3])
+        return
+    arg = sys.argv[1] if len(sys.argv) > 1 else '30'
+    if os.path.isdir(arg):
+        pages = load_pages(arg)
+        print(f'pages from {arg}')
+    else:
+        pages = sample_pages(int(arg))
+        print(f'synthetic pages, {arg} wifi clients')
+    print(f'{sum(len(html) for html in pages.values()) / 1e3:.0f} kB of html')
+
+    try:
+        run('pd.read_html', bench_read_html, pages, arg)
+    except (ImportError, subprocess.CalledProcessError) as e:
+        print(f'pd.read_html unavailable: {e}')
+    run('extract_tables', bench_extract_tables, pages, arg)
+    run('parse_router_pages', bench_parse_router_pages, pages, arg)
+
+
+if __name__ == '__main__':
+    main()
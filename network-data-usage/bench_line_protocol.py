@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""Benchmark: converting one poll's stats to InfluxDB line protocol
+
+Compares `main.stats_to_line_protocol` with the row by row conversion it
+replaced (a dict per row from `df.to_dict(orient='index')`, turned into line
+protocol by the influxdb client's `make_lines` in `write_points`), on
+synthetic router pages with the per-device rates added, and checks both produce the same lines.
+
+    $ python3 bench_line_protocol.py [clients ...]      # 30 100 300 1000 by default
+
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+from influxdb.line_protocol import make_lines
+
+import arris_router_api as api
+import main
+from sample_pages import sample_pages
+
+
+def row_wise_points(df, timestamp, measurement, fields, tags):
+    points = []
+    for k, row in df.to_dict(orient='index').items():
+        points.append({
+            'time': row.get('timestamp', timestamp),
+            'measurement': measurement,
+            'tags': {
+                main.sanitize_name(tag): f(row[tag]) for tag, f in tags.items()
+                if row[tag] is not None and pd.notna(row[tag])
+            },
+            'fields': {
+                main.sanitize_name(field): f(row[field]) for field, f in fields.items()
+                if row[field] is not None and pd.notna(row[field])
+            },
+        })
+    return points
+
+
+def row_wise(stats):
+    # run stats_to_line_protocol with the old per-row conversion swapped in
+    points = []
+    df_to_lines = main.df_to_lines
+    main.df_to_lines = lambda *args, **kwargs: points.extend(row_wise_points(*args, **kwargs)) or []
+    try:
+        main.stats_to_line_protocol(stats)
+    finally:
+        main.df_to_lines = df_to_lines
+    return make_lines({'points': points}, precision='n').encode('utf-8')
+
+
+def with_rates(stats):
+    # the rate fields main() adds, from a poll a minute earlier with half the traffic
+    rates = api.DeviceRates()
+    earlier = stats.device_stats.copy()
+    for counter in api.RATE_COUNTERS:
+        if counter in earlier:
+            earlier[counter] = earlier[counter] // 2
+    rates.add_rates(earlier, stats.timestamp - timedelta(minutes=1))
+    return stats._replace(device_stats=rates.add_rates(stats.device_stats, stats.timestamp))
+
+
+def best_of(fn, repeat=20):
+    fn()  # warm up
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times) * 1e3
+
+
+def run():
+    clients = [int(arg) for arg in sys.argv[1:]] or [30, 100, 300, 1000]
+    print(f'{"clients":>8} {"points":>8} {"row by row":>12} {"by column":>12}')
+    for count in clients:
+        pages = sample_pages(count)
+        stats = with_rates(api.parse_router_pages(*(pages[name] for name in api.PAGES), datetime.utcnow()))
+        body = main.stats_to_line_protocol(stats)
+        assert sorted(body.split(b'\n')) == sorted(row_wise(stats).strip().split(b'\n'))
+        points = body.count(b'\n') + 1
+        print(f'{count:>8} {points:>8} '
+              f'{best_of(lambda: row_wise(stats)):>9.2f} ms '
+              f'{best_of(lambda: main.stats_to_line_protocol(stats)):>9.2f} ms')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,134 @@
+"""Minimal HTML table extractor
+
+A stand-in for `pandas.read_html` on the router's status pages. Instead of
+building a document tree, one regular expression walks the table-related
+tags (`table`, `caption`, `tr`, `td`, `th`, `br`) in document order,
+skipping comments, scripts and styles, and the text between them is
+collected into cells of the wanted tables only. Tables are picked by
+position in the page (nested tables count, in document order, like
+`read_html`) or by caption, and the scan stops as soon as the last one is
+complete. Cells come back as whitespace-normalised strings, `colspan` cells
+repeated like `read_html` does.
+
+"""
+
+import html
+import re
+from typing import Dict, Iterable, List, Union
+
+TableKey = Union[int, str]
+
+_TOKEN = re.compile(
+    r'<!--.*?-->'
+    r'|<(script|style)\b.*?</\1\s*>'
+    r'|<(/?)(table|caption|tr|td|th|br)\b([^>]*)>',
+    re.IGNORECASE | re.DOTALL,
+)
+_TAG = re.compile(r'<[^>]*>')
+_WHITESPACE = re.compile(r'\s+')
+_COLSPAN = re.compile(r'colspan\s*=\s*["\']?(\d+)', re.IGNORECASE)
+
+
+def _clean(parts):
+    text = ''.join(parts)
+    if '<' in text:
+        text = _TAG.sub('', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+class _Table:
+    __slots__ = ('index', 'collect', 'rows', 'row', 'cell', 'colspan', 'caption')
+
+    def __init__(self, index, collect):
+        self.index = index
+        self.collect = collect
+        self.rows = []
+        self.row = None
+        self.cell = None
+        self.colspan = 1
+        self.caption = None
+
+    def close_cell(self):
+        if self.cell is not None:
+            self.row.extend([_clean(self.cell)] * self.colspan)
+            self.cell = None
+
+    def close_row(self):
+        self.close_cell()
+        if self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+
+def extract_tables(page: str, wanted: Iterable[TableKey]) -> Dict[TableKey, List[List[str]]]:
+    """
+    Return `{key: rows}` for every table in `wanted` (positions or captions),
+    each row a list of cell strings. Raises ValueError if a table is missing.
+    """
+    wanted = set(wanted)
+    indexes = {key for key in wanted if isinstance(key, int)}
+    captions = wanted - indexes
+    tables = {}
+    open_tables = []
+    count = 0
+    position = 0
+
+    for match in _TOKEN.finditer(page):
+        table = open_tables[-1] if open_tables else None
+        if table is not None and table.collect:
+            # text since the previous tag
+            if table.cell is not None:
+                table.cell.append(page[position:match.start()])
+            elif table.caption is not None and not isinstance(table.caption, str):
+                table.caption.append(page[position:match.start()])
+        position = match.end()
+        tag = match.group(3)
+        if tag is None:
+            # comment, script or style
+            continue
+        tag = tag.lower()
+        closing = match.group(2) == '/'
+
+        if tag == 'table':
+            if not closing:
+                # without captions to look for, unwanted tables are only counted
+                open_tables.append(_Table(count, count in indexes or bool(captions)))
+                count += 1
+                continue
+            if table is None:
+                continue
+            open_tables.pop()
+            if not table.collect:
+                continue
+            table.close_row()
+            if table.index in indexes:
+                tables[table.index] = table.rows
+            if isinstance(table.caption, str) and table.caption in captions:
+                tables[table.caption] = table.rows
+            if len(tables) == len(wanted):
+                break
+        elif table is None or not table.collect:
+            continue
+        elif tag == 'tr':
+            table.close_row()
+            if not closing:
+                table.row = []
+        elif tag in ('td', 'th'):
+            table.close_cell()
+            if not closing:
+                if table.row is None:
+                    table.row = []
+                table.cell = []
+                colspan = _COLSPAN.search(match.group(4))
+                table.colspan = int(colspan.group(1)) if colspan else 1
+        elif tag == 'caption':
+            table.caption = _clean(table.caption) if closing and table.caption is not None else []
+        elif tag == 'br' and table.cell is not None:
+            table.cell.append(' ')
+
+    missing = wanted - tables.keys()
+    if missing:
+        raise ValueError(f'tables {sorted(missing, key=str)} not found')
+    return tables
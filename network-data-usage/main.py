@@ -12,30 +12,126 @@ def sanitize_name(name: str) -> str:
         .replace(' ', '_')
     )
 
-def df_to_points(df: pd.DataFrame, timestamp, measurement: str, fields: Dict[str, Callable], tags: Dict[str, Callable]):
-    fallback_timestamp = timestamp
-    points = []
-    for k, row in df.to_dict(orient='index').items():
-        data_point = {
-            'time': fallback_timestamp,
-            'measurement': measurement,
-            'tags': {
-                sanitize_name(tag): f(row[tag]) for tag, f in tags.items()
-                if row[tag] is not None and pd.notna(row[tag])
-            },
-            'fields': {
-                sanitize_name(field): f(row[field]) for field, f in fields.items()
-                if row[field] is not None and pd.notna(row[field])
-            },
-        }
-        if 'timestamp' in row:
-            data_point['time'] = row['timestamp']
-        points.append(data_point)
-    return points
-
-def stats_to_points(stats: NetworkInfo):
-    points = []
-    points += df_to_points(
+# metadata is rewritten this often even when unchanged, so dashboards find it in recent data
+METADATA_HEARTBEAT = 3600 # seconds
+
+EPOCH = pd.Timestamp(0)
+NANOSECOND = pd.Timedelta(1, 'ns')
+
+KEY_ESCAPES = str.maketrans({'\\': '\\\\', ' ': '\\ ', ',': '\\,', '=': '\\='})
+TAG_VALUE_ESCAPES = str.maketrans({'\\': '\\\\', ' ': '\\ ', ',': '\\,', '=': '\\=', '\n': '\\n'})
+STRING_FIELD_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+def format_column(column: pd.Series, cast: Callable, tag: bool) -> List[str]:
+    """
+    `column` cast with `cast` and formatted as line protocol tag or field values,
+    with '' for nulls (and values InfluxDB would reject).
+    """
+    values = column.to_numpy()
+    present = pd.notna(values)
+    if cast is int:
+        # one vectorized cast for the whole column, nulls set to 0 and blanked below
+        values = np.where(present, values, 0).astype(np.int64).tolist()
+        template = '%d' if tag else '%di'
+        return [template % value if p else '' for value, p in zip(values, present.tolist())]
+    if cast is float:
+        values = np.where(present, values, 0.0).astype(np.float64)
+        present &= np.isfinite(values)
+        return [repr(value) if p else '' for value, p in zip(values.tolist(), present.tolist())]
+    values = [str(cast(value)) if p else '' for value, p in zip(values.tolist(), present.tolist())]
+    if tag:
+        return [value.translate(TAG_VALUE_ESCAPES) for value in values]
+    return ['"' + value.translate(STRING_FIELD_ESCAPES) + '"' if value else '' for value in values]
+
+def df_to_lines(df: pd.DataFrame, timestamp, measurement: str, fields: Dict[str, Callable], tags: Dict[str, Callable]) -> List[str]:
+    """
+    One line protocol line per row of `df` that has at least one field, built column by
+    column: each tag and field is null-masked, cast and escaped once for the whole column,
+    and the rows are assembled from the formatted columns. Tags and fields are sorted by
+    key like `influxdb.line_protocol` does. Rows are timestamped with their 'timestamp'
+    column if present, else `timestamp`.
+    """
+    if df.empty:
+        return []
+
+    def columns(casts: Dict[str, Callable], tag: bool) -> List[List[str]]:
+        formatted = []
+        for name in sorted({name for name in casts if name in df}, key=sanitize_name):
+            key = sanitize_name(name).translate(KEY_ESCAPES) + '='
+            formatted.append([key + value if value else '' for value in format_column(df[name], casts[name], tag)])
+        return formatted
+
+    tag_columns = columns(tags, tag=True)
+    if tag_columns:
+        tag_sets = [''.join(',' + value for value in row if value) for row in zip(*tag_columns)]
+    else:
+        tag_sets = [''] * len(df)
+    field_sets = [','.join(value for value in row if value) for row in zip(*columns(fields, tag=False))]
+
+    if 'timestamp' in df:
+        times = pd.to_datetime(df['timestamp']).fillna(pd.Timestamp(timestamp))
+        times = ((times - EPOCH) // NANOSECOND).tolist()
+    else:
+        times = [(pd.Timestamp(timestamp) - EPOCH) // NANOSECOND] * len(df)
+
+    prefix = measurement.translate(KEY_ESCAPES)
+    return [
+        f'{prefix}{tag_set} {field_set} {time}'
+        for tag_set, field_set, time in zip(tag_sets, field_sets, times)
+        if field_set
+    ]
+
+class MetadataCache:
+    """
+    Fingerprints of the metadata points last written, per measurement and key, so
+    slowly changing metadata is only written when it changes, or every `heartbeat`.
+    """
+
+    def __init__(self, heartbeat=METADATA_HEARTBEAT):
+        self.heartbeat = heartbeat
+        self._written = {}
+        self._pending = {}
+
+    def changed(self, df: pd.DataFrame, measurement: str, key_columns: List[str], columns: List[str], timestamp) -> pd.DataFrame:
+        """The rows of `df` whose `columns` changed since they were last written, or are due again."""
+        key_columns = [column for column in key_columns if column in df]
+        columns = [column for column in columns if column in df]
+        keep = []
+        for row in zip(*(df[column].tolist() for column in key_columns + columns)):
+            row = tuple(None if pd.isna(value) else value for value in row)
+            key = (measurement,) + row[:len(key_columns)]
+            fingerprint = row[len(key_columns):]
+            written = self._written.get(key)
+            due = (
+                written is None
+                or written[0] != fingerprint
+                or (timestamp - written[1]).total_seconds() >= self.heartbeat
+            )
+            if due:
+                self._pending[key] = (fingerprint, timestamp)
+            keep.append(due)
+        return df[keep]
+
+    def commit(self):
+        """Record the rows returned by `changed` as written, once the write succeeded."""
+        self._written.update(self._pending)
+        self._pending.clear()
+
+def stats_to_line_protocol(stats: NetworkInfo, metadata: MetadataCache = None) -> bytes:
+    """
+    Counters are written on every poll, tagged as they always were except for the
+    broadband addresses (IPv4/IPv6 addresses, gateways and DNS servers), which
+    change too often to be part of a series key. Those go to `network_broadband_info`,
+    and with a `metadata` cache only when they changed or their heartbeat is due.
+    """
+
+    def metadata_lines(df, measurement, fields, tags):
+        if metadata is not None:
+            df = metadata.changed(df, measurement, list(tags), list(fields), stats.timestamp)
+        return df_to_lines(df, timestamp=stats.timestamp, measurement=measurement, fields=fields, tags=tags)
+
+    lines = []
+    lines += df_to_lines(
         stats.device_stats,
         timestamp=stats.timestamp,
         measurement='network_device_stats',
@@ -57,6 +153,10 @@ def stats_to_points(stats: NetworkInfo):
             'Disassoc Count': int,
             'Deauth Count': int,
             'Signal Strength': str,
+            'receive_bps': float,
+            'transmit_bps': float,
+            'receive_pps': float,
+            'transmit_pps': float,
         },
         tags={
             # 'IP Address',
@@ -75,7 +175,7 @@ def stats_to_points(stats: NetworkInfo):
             'ethernet_port': str,
         }
     )
-    points += df_to_points(
+    lines += df_to_lines(
         stats.device_count_by_interface,
         timestamp=stats.timestamp,
         measurement='network_device_count_by_interface',
@@ -88,7 +188,7 @@ def stats_to_points(stats: NetworkInfo):
             'Status': str,
         }
     )
-    points += df_to_points(
+    lines += df_to_lines(
         stats.wifi_radio_stats,
         timestamp=stats.timestamp,
         measurement='network_wifi_radio_stats',
@@ -120,7 +220,7 @@ def stats_to_points(stats: NetworkInfo):
             # 'Wi-Fi Radio',
         }
     )
-    points += df_to_points(
+    lines += df_to_lines(
         stats.broadband_stats,
         timestamp=stats.timestamp,
         measurement='network_broadband_stats',
@@ -145,25 +245,31 @@ def stats_to_points(stats: NetworkInfo):
         tags={
             # 'IPv6 Status',
             # 'IPv6 Service Type',
-            'IPv6 Global Unicast IPv6 Address': str,
-            'IPv6 Link Local Address': str,
-            'IPv6 Default IPv6 Gateway Address': str,
-            'IPv6 Global Unicast IPv6 Address': str,
-            'IPv6 Link Local Address': str,
-            'IPv6 Default IPv6 Gateway Address': str,
             # 'IPv6 MTU',
             'Broadband Connection Source': str,
             'Broadband Connection': str,
             'Broadband Network Type': str,
+            'MAC Address': str,
+            # 'MTU',
+        }
+    )
+    lines += metadata_lines(
+        stats.broadband_stats,
+        measurement='network_broadband_info',
+        fields={
+            'IPv6 Global Unicast IPv6 Address': str,
+            'IPv6 Link Local Address': str,
+            'IPv6 Default IPv6 Gateway Address': str,
             'Broadband IPv4 Address': str,
             'Gateway IPv4 Address': str,
-            'MAC Address': str,
             'Primary DNS': str,
             'Secondary DNS': str,
-            # 'MTU',
+        },
+        tags={
+            'MAC Address': str,
         }
     )
-    return points
+    return '\n'.join(lines).encode('utf-8')
 
 
 def main():
@@ -171,7 +277,9 @@ def main():
     from time import sleep
     import random
     from datetime import datetime, timedelta
+    import requests
     from influxdb import InfluxDBClient
+    from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
 
     min_wait = 50 # seconds
     max_wait = 70 # seconds
@@ -199,12 +307,33 @@ def main():
 
     _init_influxdb_database()
 
+    device_rates = DeviceRates()
+    metadata = MetadataCache()
+
     while True:
-        stats = query_router_stats()
-        points = stats_to_points(stats)
-        print(f'writing {points} to influxdb')
-        success = influxdb_client.write_points(points)
-        print(success)
+        try:
+            stats = query_router_stats()
+        except requests.RequestException as e:
+            print(f'failed to fetch the router stats, skipping this poll: {e!r}')
+            random_wait()
+            continue
+        stats = stats._replace(device_stats=device_rates.add_rates(stats.device_stats, stats.timestamp))
+        body = stats_to_line_protocol(stats, metadata)
+        points = body.count(b'\n') + 1 if body else 0
+        print(f'writing {points} points ({len(body)} bytes) to influxdb')
+        try:
+            influxdb_client.request(
+                url='write',
+                method='POST',
+                params={'db': INFLUXDB_DATABASE, 'precision': 'n'},
+                data=body,
+                expected_response_code=204,
+                headers={'Content-Type': 'application/octet-stream'},
+            )
+        except (requests.RequestException, InfluxDBClientError, InfluxDBServerError) as e:
+            print(f'failed to write to influxdb, skipping this poll: {e!r}')
+        else:
+            metadata.commit()
 
         random_wait()
 
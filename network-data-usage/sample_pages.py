@@ -0,0 +1,135 @@
+"""Synthetic router pages for the benchmarks
+
+Mimic the layout of the router's `lanstatistics.ha`, `devices.ha` and
+`broadbandstatistics.ha` (the tables the collector reads, at the same
+positions, plus page chrome), for any number of wifi clients. Pages saved
+from the real router with `arris_router_api.capture_pages()` can be loaded
+with `load_pages` instead.
+
+"""
+
+import os
+import random
+
+from arris_router_api import LAN_STATISTICS_PAGE, DEVICES_PAGE, BROADBAND_STATISTICS_PAGE, PAGES
+
+RADIOS = ['2.4 GHz', '5 GHz']
+ETHERNET_PORTS = ['Port 1', 'Port 2', 'Port 3', 'Port 4']
+DEVICE_STATS = [
+    'Transmit Packets', 'Transmit Bytes', 'Transmit Speed', 'Transmit Unicast', 'Transmit Multicast',
+    'Transmit Dropped', 'Transmit Errors', 'Receive Packets', 'Receive Bytes', 'Receive Unicast',
+    'Receive Multicast', 'Receive Dropped', 'Receive Errors',
+]
+WIFI_CLIENT_STATS = ['Trans Errors', 'Disassoc Count', 'Deauth Count']
+WIFI_PACKET_STATS = [
+    'Current Data Throughput', '24 Hour Peak Data Throughput', 'Transmit Bytes', 'Receive Bytes',
+    'Transmit Packets', 'Receive Packets', 'Transmit Error Packets', 'Receive Error Packets',
+    'Transmit Discard Packets', 'Receive Discard Packets',
+]
+
+CHROME = (
+    '<html><head><title>Status</title><script>' + 'var x = 1;' * 200 + '</script></head><body>'
+    '<div id="nav"><ul>' + ''.join(f'<li><a href="/cgi-bin/{i}.ha">Page {i}</a></li>' for i in range(40)) + '</ul></div>'
+)
+END = '<div id="footer">' + '<p>Copyright</p>' * 20 + '</div></body></html>'
+
+
+def _table(rows, header=None):
+    html = ['<table class="table100">']
+    if header is not None:
+        html.append('<tr>' + ''.join(f'<th>{cell}</th>' for cell in header) + '</tr>')
+    for row in rows:
+        html.append('<tr>' + ''.join(f'<td>{cell}</td>' for cell in row) + '</tr>')
+    html.append('</table>')
+    return '\n'.join(html)
+
+
+def _mac(i):
+    return 'a4:5e:60:{:02x}:{:02x}:{:02x}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+
+
+def lan_statistics_page(clients, rng):
+    tables = [
+        _table([['LAN', 'Up']]),
+        _table([['Ethernet', 'Up', 4, 1], ['Wi-Fi', 'Up', clients, 3]],
+               ['Interface', 'Status', 'Active Devices', 'Inactive Devices']),
+        _table([['a', 'b']]),
+        _table([['c', 'd']]),
+        _table([['e', 'f']]),
+        _table(
+            [['Wi-Fi Radio Status', 'Enabled', 'Enabled'], ['Mode', '802.11n', '802.11ac'],
+             ['Bandwidth', '20 MHz', '80 MHz'], ['Current Radio Channel', 6, 149],
+             ['Radio Channel Selection', 'Automatic', 'Automatic'], ['Power Level', '100%', '100%'],
+             ['', '', ''], ['Guest SSID', 'Disabled', 'Disabled'], ['Network Name (SSID)', 'guest', 'guest']],
+            [''] + RADIOS,
+        ),
+        _table([['', *RADIOS]] + [[label, rng.randrange(10 ** 9), rng.randrange(10 ** 9)] for label in WIFI_PACKET_STATS]),
+        _table(
+            [[_mac(i)] + [rng.randrange(10 ** 9) for _ in DEVICE_STATS + WIFI_CLIENT_STATS] + [f'-{rng.randrange(30, 90)} dBm']
+             for i in range(clients)],
+            ['MAC Address'] + DEVICE_STATS + WIFI_CLIENT_STATS + ['Signal Strength'],
+        ),
+        _table([[label] + [rng.randrange(10 ** 9) for _ in ETHERNET_PORTS] for label in DEVICE_STATS], [''] + ETHERNET_PORTS),
+    ]
+    return CHROME + '\n'.join(tables) + END
+
+
+def devices_page(clients, rng):
+    rows = []
+    for i in range(clients):
+        rows += [
+            ['MAC Address', _mac(i)],
+            ['IPv4 Address / Name', f'192.168.1.{i % 250 + 2} / device-{i}'],
+            ['Last Activity', 'Mon Jun 22 10:51:12 2020'],
+            ['Status', 'on'],
+            ['Allocation', 'dhcp'],
+            ['Connection Type', f'Wi-Fi {RADIOS[i % 2]}'],
+            ['Access Point', 'Gateway'],
+            ['Radio Channel', 6 if i % 2 == 0 else 149],
+            ['', ''],
+        ]
+    for port in range(1, 5):
+        rows += [
+            ['MAC Address', _mac(10 ** 6 + port)],
+            ['IPv4 Address / Name', f'192.168.1.{250 + port} / wired-{port}'],
+            ['Connection Type', f'Ethernet LAN-{port}'],
+            ['', ''],
+        ]
+    return CHROME + _table(rows) + END
+
+
+def broadband_statistics_page(rng):
+    tables = [
+        _table([['Broadband Connection Source', 'FIBER'], ['Broadband Connection', 'Up'],
+                ['Broadband Network Type', 'Static'], ['Broadband IPv4 Address', '203.0.113.7'],
+                ['Gateway IPv4 Address', '203.0.113.1'], ['MAC Address', 'a4:5e:60:00:00:01'],
+                ['Primary DNS', '192.0.2.53'], ['Secondary DNS', '192.0.2.54']]),
+        _table([['Line', '1']]),
+        _table([['Status', 'Available'], ['Global Unicast IPv6 Address', '2001:db8::7'],
+                ['Link Local Address', 'fe80::1'], ['Default IPv6 Gateway Address', 'fe80::2']]),
+        _table([[label, rng.randrange(10 ** 9)] for label in [
+            'Receive Packets', 'Transmit Packets', 'Receive Bytes', 'Transmit Bytes', 'Receive Unicast',
+            'Transmit Unicast', 'Receive Multicast', 'Transmit Multicast', 'Receive Drops', 'Transmit Drops',
+            'Receive Errors', 'Transmit Errors', 'Collisions']]),
+        _table([[label, rng.randrange(10 ** 9)] for label in ['Transmit Packets', 'Transmit Errors', 'Transmit Discards']]),
+    ]
+    return CHROME + '\n'.join(tables) + END
+
+
+def sample_pages(clients=30, seed=0):
+    """`{page name: html}` for `clients` wifi clients and 4 wired ones."""
+    rng = random.Random(seed)
+    return {
+        LAN_STATISTICS_PAGE: lan_statistics_page(clients, rng),
+        DEVICES_PAGE: devices_page(clients, rng),
+        BROADBAND_STATISTICS_PAGE: broadband_statistics_page(rng),
+    }
+
+
+def load_pages(directory):
+    """Pages saved by `arris_router_api.capture_pages(directory)`."""
+    pages = {}
+    for name in PAGES:
+        with open(os.path.join(directory, f'{name}.html')) as f:
+            pages[name] = f.read()
+    return pages
@@ -1,5 +1,5 @@
 #!/bin/sh
 
-mkdir -p datadir/ datadir/mosquitto/ datadir/grafana/
+mkdir -p datadir/ datadir/mosquitto/ datadir/grafana/ datadir/mqttbridge/spool/
 sudo chown -R 1883:root datadir/mosquitto/
 sudo chown -R 472:root datadir/grafana/
@@ -1,7 +1,8 @@
 import os
+import json
 from influxdb import InfluxDBClient
 from datetime import datetime, timedelta
-from time import sleep
+from time import sleep, time, monotonic
 import random
 import speedtest
 
@@ -13,14 +14,107 @@ threads = None
 # If you want to use a single threaded test
 # threads = 1
 
+# The server list and the chosen server are kept between runs, so a run usually
+# pings a single server instead of downloading the list and pinging the closest ones.
+SERVER_CACHE_PATH = os.environ.get('SPEEDTEST_SERVER_CACHE', 'speedtest_servers.json')
+SERVER_LIST_TTL = 7*24*60*60 # seconds
+BEST_SERVER_TTL = 24*60*60 # seconds
+CLOSEST_SERVERS = 5 # candidates pinged when picking a server
+# probe again when the cached server's ping is this much worse than when it was picked
+DEGRADED_LATENCY_FACTOR = 2.0
+DEGRADED_LATENCY_MARGIN = 20 # ms
+# speedtest-cli counts a failed ping as 3600 s, a ping this high means one of its 3 failed
+FAILED_LATENCY = 600000 # ms
+# speedtest-cli reports a failed download or upload as a (near) zero speed instead of raising
+FAILED_SPEED = 1000 # bits per second
+# servers tried per run when the test against one fails
+SERVER_ATTEMPTS = 2
+
+
+def load_server_cache(path=SERVER_CACHE_PATH):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    # picked with other server ids configured
+    if cache.get('servers_filter') != servers:
+        return {}
+    return cache
+
+
+def save_server_cache(cache, path=SERVER_CACHE_PATH):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def evict_server(cache, server_id):
+    """Forget `server_id` as the chosen server and as a candidate, so the next pick avoids it."""
+    if cache.get('best', {}).get('id') == server_id:
+        cache.pop('best')
+    if cache.get('servers'):
+        cache['servers'] = [server for server in cache['servers'] if server['id'] != server_id]
+
+
+def choose_server(s, cache):
+    """Sets the server `s` tests against, returns whether the cached one was used."""
+    now = time()
+    best = cache.get('best')
+    if best is not None and now - cache['best_time'] < BEST_SERVER_TTL:
+        s.get_best_server([best])
+        latency = s.results.ping
+        baseline = cache['best_latency']
+        if latency < FAILED_LATENCY and latency <= max(baseline * DEGRADED_LATENCY_FACTOR, baseline + DEGRADED_LATENCY_MARGIN):
+            return True
+        print(f'server {best["id"]} ping {latency} ms, was {baseline} ms, picking a server again')
+
+    list_cached = bool(cache.get('servers')) and now - cache['servers_time'] < SERVER_LIST_TTL
+    if list_cached:
+        s.get_best_server(cache['servers'])
+    if not list_cached or s.results.ping >= FAILED_LATENCY:
+        s.get_servers(list(servers))
+        candidates = s.get_closest_servers(CLOSEST_SERVERS)
+        cache.update(servers=candidates, servers_time=now, servers_filter=servers)
+        s.get_best_server(candidates)
+    cache.update(best=s.results.server, best_time=now, best_latency=s.results.ping)
+    return False
+
+
 def do_speed_test():
-    s = speedtest.Speedtest()
-    s.get_servers(servers)
-    s.get_best_server()
-    s.download(threads=threads)
-    s.upload(threads=threads)
+    cache = load_server_cache()
+    for attempt in range(SERVER_ATTEMPTS):
+        started = monotonic()
+        s = speedtest.Speedtest()
+        server_cached = choose_server(s, cache)
+        discovery_seconds = monotonic() - started
+        server_id = s.results.server['id']
+        print(f'testing against server {server_id} ({"cached" if server_cached else "picked"}), ping {s.results.ping} ms')
+
+        started = monotonic()
+        try:
+            s.download(threads=threads)
+            s.upload(threads=threads)
+        except Exception:
+            # pick a server again next time
+            evict_server(cache, server_id)
+            save_server_cache(cache)
+            raise
+        measurement_seconds = monotonic() - started
+        if s.results.download >= FAILED_SPEED and s.results.upload >= FAILED_SPEED:
+            break
+        print(f'server {server_id} measured {s.results.download} bps down, {s.results.upload} bps up, picking a server again')
+        evict_server(cache, server_id)
+    save_server_cache(cache)
+
     s.results.share()
-    return s.results.dict()
+    return {
+        **s.results.dict(),
+        'server_cached': server_cached,
+        'discovery_seconds': discovery_seconds,
+        'measurement_seconds': measurement_seconds,
+    }
 
 min_wait = 0.5 # hours
 max_wait = 2.0 # hours
@@ -82,6 +176,9 @@ def main():
                 'server_host':    result['server']['host'],
                 'server_d':       result['server']['d'],
                 'server_latency': result['server']['latency'],
+                'server_cached':       result['server_cached'],
+                'discovery_seconds':   result['discovery_seconds'],
+                'measurement_seconds': result['measurement_seconds'],
             },
         }
         print(f'writing {data_point} to influxdb')
@@ -0,0 +1,126 @@
+"""Local stand-in for speedtest.net
+
+Serves what speedtest-cli asks for: the client configuration, a server list
+of `--servers` test servers (all on this port, the n-th one answering pings
+n * `--latency` ms late), latency.txt, download images, uploads and result
+sharing. speedtest-cli fetches the configuration and server list from
+www.speedtest.net through urllib, so it is pointed here as an HTTP proxy;
+the test servers' URLs point here directly.
+
+    $ python3 stand_in_speedtest.py --port 8099
+    $ http_proxy=http://127.0.0.1:8099 INFLUXDB_ADDRESS=... python3 speedtest_main.py
+
+"""
+
+import argparse
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+CONFIG = '''<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<client ip="127.0.0.1" lat="41.8781" lon="-87.6298" isp="Stand-in ISP" isprating="3.7" rating="0" ispdlavg="0" ispulavg="0" loggedin="0" country="US" />
+<server-config threadcount="2" ignoreids="0" notonmap="" forcepingid="" preferredserverid="" />
+<download testlength="2" initialtest="250K" mintestsize="250K" threadsperurl="2" />
+<upload testlength="2" ratio="5" initialtest="0" mintestsize="32K" threads="2" maxchunksize="512K" maxchunkcount="10" threadsperurl="2" />
+</settings>
+'''
+
+DOWNLOAD_SIZE = 256 * 1024 # bytes per image, whatever size is asked for
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    servers = 3
+    latency = 0.01 # seconds
+    down = set() # server numbers that fail
+    requests = {}
+
+    def serverList(self):
+        host = f'127.0.0.1:{self.server.server_port}'
+        servers = ''.join(
+            f'<server url="http://{host}/s{n}/upload.php" lat="{41.8 + n / 10}" lon="-87.6" name="Stand-in {n}" '
+            f'country="United States" cc="US" sponsor="Stand-in" id="{9000 + n}" host="{host}" />\n'
+            for n in range(1, self.servers + 1)
+        )
+        return f'<?xml version="1.0" encoding="UTF-8"?>\n<settings>\n<servers>\n{servers}</servers>\n</settings>\n'
+
+    def count(self, kind):
+        Handler.requests[kind] = Handler.requests.get(kind, 0) + 1
+
+    def respond(self, body, status=200, content_type='text/plain'):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serverNumber(self, path):
+        # /s<n>/...
+        try:
+            return int(path.split('/')[1][1:])
+        except (IndexError, ValueError):
+            return 0
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith('speedtest-config.php'):
+            self.count('config')
+            self.respond(CONFIG, content_type='text/xml')
+        elif path.endswith('speedtest-servers-static.php') or path.endswith('speedtest-servers.php'):
+            self.count('server list')
+            self.respond(self.serverList(), content_type='text/xml')
+        elif path.endswith('latency.txt'):
+            self.count('latency')
+            n = self.serverNumber(path)
+            if n in self.down:
+                self.respond('down', status=503)
+                return
+            time.sleep(n * self.latency)
+            self.respond('test=test\n')
+        elif '/random' in path:
+            self.count('download')
+            if self.serverNumber(path) in self.down:
+                self.respond('down', status=503)
+                return
+            self.respond(bytes(DOWNLOAD_SIZE), content_type='image/jpeg')
+        else:
+            self.respond('not found', status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if path.endswith('upload.php'):
+            self.count('upload')
+            self.respond(f'size={length}')
+        elif path.endswith('api.php'):
+            self.count('share')
+            self.respond('resultid=1')
+        else:
+            self.respond('not found', status=404)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=10, help='ms of ping per server number')
+    parser.add_argument('--down', type=int, nargs='*', default=[], help='server numbers that fail')
+    args = parser.parse_args()
+    Handler.servers = args.servers
+    Handler.latency = args.latency / 1000
+    Handler.down = set(args.down)
+
+    server = ThreadingHTTPServer(('', args.port), Handler)
+    print(f'speedtest stand-in with {args.servers} servers on port {args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# backfill.py
+"""Backfill Elitech cloud readings into InfluxDB
+
+The bridge only asks for readings since its last poll, one page after
+another, so history from before it ran, or a long outage it should not
+crawl through serially, is left to this tool. It splits any date range
+into chunks (a day by default), pages through each chunk with a few
+workers at a capped request rate, and writes the readings in large batches,
+as the bridge would have. Chunks are recorded in a checkpoint file once
+their readings are written, so an interrupted backfill resumes where it
+stopped when run again with the same arguments.
+
+    $ python3 backfill.py 2020-06-01 2020-06-15
+    $ python3 backfill.py '2020-06-01 12:00' --workers 2 --rate 1 --dry-run
+
+Uses the same environment variables as main.py, including TEMTOP_BASE_URL
+(see stand_in_api.py for a local stand-in). Dates are in the device's time
+zone.
+
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+from temtop_api import TemtopApi, PAGE_SIZE
+import main
+
+CHECKPOINT_PATH = 'backfill_checkpoint.json'
+
+
+class RateLimiter:
+    """Spaces calls to `wait` at least 1/`rate` seconds apart, across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.nextTime = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.nextTime - now
+            self.nextTime = max(now, self.nextTime) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Checkpoint:
+    """The chunks already written, kept in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.done = set(json.load(f))
+        except FileNotFoundError:
+            self.done = set()
+
+    @staticmethod
+    def key(deviceId, start, end):
+        return f'{deviceId} {start.isoformat()} {end.isoformat()}'
+
+    def add(self, keys):
+        self.done.update(keys)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(sorted(self.done), f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def chunks(start: datetime, end: datetime, size: timedelta):
+    while start < end:
+        yield start, min(start + size, end)
+        start += size
+
+
+def fetchChunk(api: TemtopApi, limiter: RateLimiter, deviceId, start, end, pageSize):
+    """All the readings between `start` and `end`, page by page."""
+    return api.parseM10iDeviceData(api.getAllDeviceData(deviceId, start, end, rows=pageSize, beforePage=limiter.wait))
+
+
+def parseDate(text, timezone):
+    return timezone.localize(datetime.fromisoformat(text))
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('start', help="e.g. 2020-06-01 or '2020-06-01 12:00'")
+    parser.add_argument('end', nargs='?', help='now by default')
+    parser.add_argument('--device', type=int, help='device id, the first device by default')
+    parser.add_argument('--chunk-hours', type=float, default=24)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=2, help='max requests per second, 0 for no limit')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--batch-size', type=int, default=20000, help='points per InfluxDB write')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    parser.add_argument('--dry-run', action='store_true', help='fetch and parse, but write nothing')
+    args = parser.parse_args()
+
+    api = TemtopApi(main.TEMPTOP_USER, main.TEMPTOP_PASS, main.TEMTOP_BASE_URL, max_connections=args.workers)
+    start = parseDate(args.start, api.timezone)
+    end = parseDate(args.end, api.timezone) if args.end else datetime.now(api.timezone)
+    deviceId = args.device if args.device is not None else api.getFirstDeviceId()
+    device = next((d for d in api.getDeviceList() if d['id'] == deviceId), {'id': deviceId})
+
+    checkpoint = Checkpoint(args.checkpoint)
+    todo = [
+        (chunkStart, chunkEnd) for chunkStart, chunkEnd in chunks(start, end, timedelta(hours=args.chunk_hours))
+        if Checkpoint.key(deviceId, chunkStart, chunkEnd) not in checkpoint.done
+    ]
+    print(f'device {deviceId}: {len(todo)} chunks to fetch from {start} to {end}')
+    if not args.dry_run:
+        main._init_influxdb_database()
+
+    limiter = RateLimiter(args.rate)
+    points = []
+    pendingChunks = []
+    written = 0
+    started = time.monotonic()
+
+    def flush():
+        nonlocal written
+        if not args.dry_run:
+            if points:
+                main.influxdb_client.write_points(points, time_precision='s', batch_size=args.batch_size, protocol='line')
+            checkpoint.add(pendingChunks)
+        written += len(points)
+        print(f'{written} points written, {len(checkpoint.done)} chunks done, {time.monotonic() - started:.1f}s')
+        points.clear()
+        pendingChunks.clear()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        remaining = iter(todo)
+        running = {}
+        while True:
+            # keep only a few chunks ahead of the writes
+            for chunkStart, chunkEnd in remaining:
+                future = executor.submit(fetchChunk, api, limiter, deviceId, chunkStart, chunkEnd, args.page_size)
+                running[future] = Checkpoint.key(deviceId, chunkStart, chunkEnd)
+                if len(running) >= 2 * args.workers:
+                    break
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                points.extend(main.to_lines(device, future.result()))
+                pendingChunks.append(running.pop(future))
+            if len(points) >= args.batch_size:
+                flush()
+    flush()
+
+
+if __name__ == '__main__':
+    run()
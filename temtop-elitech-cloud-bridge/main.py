@@ -1,19 +1,34 @@
 # main.py
 import os
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 from influxdb import InfluxDBClient
-from temtop_api import TemtopApi
+from temtop_api import TemtopApi, BASE_URL
 from datetime import datetime, timedelta
 import pytz
 from time import sleep
 
 TEMPTOP_USER = os.environ.get('TEMPTOP_USER')
 TEMPTOP_PASS = os.environ.get('TEMPTOP_PASS')
+TEMTOP_BASE_URL = os.environ.get('TEMTOP_BASE_URL', BASE_URL)
 
 INFLUXDB_ADDRESS  = os.environ.get('INFLUXDB_ADDRESS')
 INFLUXDB_USER     = os.environ.get('INFLUXDB_USER')
 INFLUXDB_PASSWORD = os.environ.get('INFLUXDB_PASSWORD')
 INFLUXDB_DATABASE = os.environ.get('INFLUXDB_DATABASE')
 
+# last reading written per device, kept across restarts
+WATERMARK_PATH = os.environ.get('TEMTOP_WATERMARK_PATH', 'watermarks.json')
+# re-request a little before the watermark, in case the cloud stores readings late
+WATERMARK_OVERLAP = timedelta(minutes=5)
+# how far back to start for a device without a watermark
+INITIAL_LOOKBACK = timedelta(minutes=30)
+
+# one point per reading time, with the readings as fields, tagged by device
+MEASUREMENT = 'air_quality'
+MAX_CONCURRENT_DEVICES = 8
+
 influxdb_client = InfluxDBClient(INFLUXDB_ADDRESS, 8086, INFLUXDB_USER, INFLUXDB_PASSWORD, None)
 
 timezone = pytz.timezone("America/Chicago")
@@ -26,45 +41,106 @@ def _init_influxdb_database():
     influxdb_client.switch_database(INFLUXDB_DATABASE)
 
 
+def load_watermarks(path=WATERMARK_PATH):
+    """`{device id: datetime of the last reading written}`"""
+    try:
+        with open(path) as f:
+            return {deviceId: datetime.fromisoformat(t) for deviceId, t in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermarks(watermarks, path=WATERMARK_PATH):
+    # write a new file and rename it over the old one, so a crash never leaves half a file
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({deviceId: t.isoformat() for deviceId, t in watermarks.items()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def escape_tag(value) -> str:
+    return (str(value)
+        .replace('\\', '\\\\')
+        .replace(' ', '\\ ')
+        .replace(',', '\\,')
+        .replace('=', '\\=')
+    )
+
+
+def to_lines(device, deviceData):
+    """
+    Line protocol for the readings returned by `getM10iDeviceData`, one line per
+    reading time, with second precision. Formats column by column, then joins rows.
+    """
+    prefix = f'{MEASUREMENT},device={escape_tag(device["id"])},location={escape_tag(device.get("name") or "M10i")} '
+    fields = [
+        [f'{name}={value!r}' if math.isfinite(value) else '' for value in deviceData[name]]
+        for name in sorted(TemtopApi.readings)
+    ]
+    return [
+        f'{prefix}{",".join(field for field in row if field)} {time}'
+        for time, *row in zip(deviceData['time'], *fields)
+        if any(row)
+    ]
+
+
+def since(deviceData, time: int):
+    """The readings of `deviceData` after `time`."""
+    keep = [t > time for t in deviceData['time']]
+    return {name: [value for value, k in zip(column, keep) if k] for name, column in deviceData.items()}
+
+
+def poll(temtopApi, device, watermark):
+    now = timezone.normalize(datetime.utcnow().replace(tzinfo=pytz.utc))
+    if watermark is None:
+        startDateTime = now - INITIAL_LOOKBACK
+    else:
+        startDateTime = watermark.astimezone(timezone) - WATERMARK_OVERLAP
+    # end 5 minutes in the future, just in case there is some time skew
+    endDateTime = now + timedelta(minutes=5)
+    deviceData = temtopApi.getM10iDeviceData(
+        deviceId=device['id'],
+        startDateTime=startDateTime,
+        endDateTime=endDateTime,
+    )
+    if watermark is not None:
+        # the overlap, already written
+        deviceData = since(deviceData, int(watermark.timestamp()))
+    print(f'device {device["id"]}: {len(deviceData["time"])} new readings from {startDateTime} to {endDateTime}')
+    return deviceData
+
+
 def main():
     _init_influxdb_database()
 
-    while True:
-
-        temtopApi = TemtopApi(TEMPTOP_USER, TEMPTOP_PASS)
-
-        deviceId = temtopApi.getFirstDeviceId()
-        
-        endDateTime = timezone.normalize(datetime.utcnow().replace(tzinfo=pytz.utc))
-        startDateTime = endDateTime - timedelta(minutes=30)
-        # end 5 minutes in the future, just in case there is some time skew
-        endDateTime += timedelta(minutes=5)
-        print('querying for:')
-        print(f'\tstartDateTime: {startDateTime}')
-        print(f'\tendDateTime:   {endDateTime}')
-        deviceData = temtopApi.getM10iDeviceData(
-            deviceId=deviceId,
-            startDateTime=startDateTime,
-            endDateTime=endDateTime,
-        )
-
-        points = []
-        for d in deviceData:
-            timestamp = d['datetime']
-            for reading_name in temtopApi.readings:
-                reading = d[reading_name]
-                point = {
-                    'time': timestamp,
-                    'measurement': reading_name,
-                    'tags': { 'location': 'M10i' },
-                    'fields': { 'value': reading },
-                }
-                points.append(point)
-        print(f'writing {len(points)} to influxdb')
-        success = influxdb_client.write_points(points)
-        print(success)
-
-        sleep(10*60)
+    # logs in once, then keeps the session (and the device list) between polls
+    temtopApi = TemtopApi(TEMPTOP_USER, TEMPTOP_PASS, TEMTOP_BASE_URL, max_connections=MAX_CONCURRENT_DEVICES)
+    watermarks = load_watermarks()
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DEVICES) as executor:
+        while True:
+            devices = temtopApi.getDeviceList()
+            results = list(executor.map(
+                lambda device: poll(temtopApi, device, watermarks.get(str(device['id']))),
+                devices,
+            ))
+
+            lines = []
+            for device, deviceData in zip(devices, results):
+                lines += to_lines(device, deviceData)
+            print(f'writing {len(lines)} points to influxdb')
+            if lines:
+                success = influxdb_client.write_points(lines, time_precision='s', protocol='line')
+                print(success)
+                # only once the points are stored, a failed write is retried from the old watermarks
+                for device, deviceData in zip(devices, results):
+                    if deviceData['time']:
+                        watermarks[str(device['id'])] = datetime.fromtimestamp(max(deviceData['time']), timezone)
+                save_watermarks(watermarks)
+
+            sleep(10*60)
 
 if __name__ == '__main__':
     print('temptop M10i (elitech cloud) to InfluxDB bridge')
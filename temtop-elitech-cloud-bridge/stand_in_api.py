@@ -0,0 +1,127 @@
+# stand_in_api.py
+"""Local stand-in for the Elitech cloud API
+
+Serves login, a device list and paged device data the way
+www.i-elitech.com does, for running backfill.py or the bridge without the
+cloud. Device data comes from a JSON file of recorded rows (the `rows` of
+`apiDeviceDataAction.do` responses, concatenated), or is one synthetic
+reading a minute over the last `--days` days.
+
+    $ python3 stand_in_api.py --port 8080 [--rows recorded.json] [--latency 0.2]
+    $ TEMTOP_BASE_URL=http://localhost:8080 python3 backfill.py 2020-06-01 2020-06-08 --dry-run
+
+"""
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytz
+
+DEVICE_ID = 1234
+# the device's wall clock, as the API reports it
+TIMEZONE = pytz.timezone('America/Chicago')
+TOKEN = 'stand-in-token'
+
+
+def createTime(d: datetime):
+    return {
+        'date': d.day, 'hours': d.hour, 'minutes': d.minute, 'month': d.month - 1,
+        'seconds': d.second, 'year': d.year - 1900,
+    }
+
+
+def parseCreateTime(createTime) -> datetime:
+    return datetime(
+        createTime['year'] + 1900, createTime['month'] + 1, createTime['date'],
+        createTime['hours'], createTime['minutes'], createTime['seconds'],
+    )
+
+
+def syntheticRows(days):
+    rng = random.Random(0)
+    end = datetime.now(TIMEZONE).replace(second=0, microsecond=0, tzinfo=None)
+    t = end - timedelta(days=days)
+    rows = []
+    while t <= end:
+        rows.append({
+            'createTime': createTime(t),
+            'probe1': f'{rng.uniform(0, 0.1):.3f}',
+            'probe2': str(rng.randrange(0, 50)),
+            'probe3': f'{rng.uniform(0, 1):.2f}',
+            'probe4': str(rng.randrange(0, 100)),
+        })
+        t += timedelta(minutes=1)
+    return rows
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    rows = []
+    devices = 1
+    latency = 0
+    requests = 0
+
+    def do_GET(self):
+        Handler.requests += 1
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.endswith('apiLoginAction.do'):
+            body = {'success': True, 'user': {'id': 1}, 'token': TOKEN}
+        elif TOKEN not in self.headers.get('Cookie', ''):
+            body = {'success': False, 'msg': 'not logged in'}
+        elif url.path.endswith('apiDeviceAction.do'):
+            body = {'success': True, 'rows': [{'id': DEVICE_ID + i, 'name': f'M10i-{i}'} for i in range(self.devices)]}
+        elif url.path.endswith('apiDeviceDataAction.do'):
+            body = self.deviceData(params)
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def deviceData(self, params):
+        start = datetime.fromisoformat(params['startDate'])
+        end = datetime.fromisoformat(params['endDate'])
+        page, size = int(params['page']), int(params['rows'])
+        matching = [row for row in self.rows if start <= parseCreateTime(row['createTime']) <= end]
+        return {'success': True, 'total': len(matching), 'rows': matching[(page - 1) * size:page * size]}
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rows', help='JSON file of recorded device data rows')
+    parser.add_argument('--days', type=int, default=7, help='days of synthetic rows, without --rows')
+    parser.add_argument('--devices', type=int, default=1, help='devices on the account, all with the same rows')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each response')
+    args = parser.parse_args()
+
+    if args.rows:
+        with open(args.rows) as f:
+            Handler.rows = json.load(f)
+    else:
+        Handler.rows = syntheticRows(args.days)
+    Handler.rows.sort(key=lambda row: parseCreateTime(row['createTime']))
+    Handler.latency = args.latency
+    Handler.devices = args.devices
+
+    server = ThreadingHTTPServer(('', args.port), Handler)
+    print(f'serving {len(Handler.rows)} rows for {args.devices} devices on port {args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,89 +1,165 @@
 # download_data.py
+import threading
 import requests
+from typing import Dict, List
 from datetime import datetime, timedelta
 import pytz
 
 
+BASE_URL = 'http://www.i-elitech.com/'
+LOGIN_PATH = '/apiLoginAction.do'
+DEVICE_LIST_PATH = '/apiDeviceAction.do'
+DEVICE_DATA_PATH = '/apiDeviceDataAction.do'
+PAGE_SIZE = 4500 # rows per data request
+
+REQUEST_TIMEOUT = 30 # seconds
+TOKEN_TTL = timedelta(hours=12) # log in again after this long, even if the token still works
+DEVICE_LIST_TTL = timedelta(hours=1)
+
+
 class TemtopApi:
     readings = [ 'HCHO', 'PM2.5', 'TVOC', 'AQI' ]
 
-    def __init__(self, username, password):
-        # do login
-        self.headers = {
-            'User-Agent': 'okhttp/2.7.5',
-        }
-        r = requests.get(
-            f'http://www.i-elitech.com//apiLoginAction.do?method=login&password={password}&username={username}',
-            headers=self.headers,
+    def __init__(self, username, password, base_url=BASE_URL, max_connections=1):
+        self.username = username
+        self.password = password
+        self.base_url = base_url
+        # one keep-alive session for all requests, login included
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = 'okhttp/2.7.5'
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.loginLock = threading.Lock()
+        self.token = None
+        self.tokenTime = None
+        self.deviceList = None
+        self.deviceListTime = None
+        self.timezone = pytz.timezone("America/Chicago")
+        self.login()
+
+    def login(self):
+        r = self.session.get(
+            self.base_url + LOGIN_PATH,
+            params={'method': 'login', 'password': self.password, 'username': self.username},
+            timeout=REQUEST_TIMEOUT,
         )
         resp = r.json()
         if not resp['success']:
             raise RuntimeError('login failed')
         self.userId = resp['user']['id']
         self.token = resp['token']
-        self.timezone = pytz.timezone("America/Chicago")
+        self.tokenTime = datetime.now()
+        self.session.headers['JSESSIONID'] = self.token
+        self.session.cookies.set('JSESSIONID', self.token)
 
+    def _request(self, url: str, params):
+        try:
+            r = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            return r.json()
+        except ValueError:
+            # an expired session can get an html page instead of json
+            return {'success': False, 'status': r.status_code}
 
     def get(self, url: str, params: None):
-        headers = {
-            'User-Agent': 'okhttp/2.7.5',
-            'JSESSIONID': self.token,
-        }
-        cookies = { 'JSESSIONID': self.token }
-        r = requests.get(url, headers=headers, cookies=cookies, params=params)
-        resp = r.json()
+        if self.token is None or datetime.now() - self.tokenTime > TOKEN_TTL:
+            with self.loginLock:
+                if self.token is None or datetime.now() - self.tokenTime > TOKEN_TTL:
+                    self.login()
+        resp = self._request(url, params)
+        if not resp['success']:
+            # most likely the token expired, log in again and retry once
+            token = self.token
+            with self.loginLock:
+                # unless another thread already did
+                if self.token == token:
+                    print(f'request failed, logging in again, response={resp}')
+                    self.login()
+            resp = self._request(url, params)
         if not resp['success']:
             print(f'request failed, response={resp}')
             raise RuntimeError('request failed')
         return resp
 
     def getDeviceList(self):
-        params={
-            'method':   'getList',
-            'typeList': '0',
-            'userId':   self.userId,
-        }
-        return self.get('http://www.i-elitech.com//apiDeviceAction.do', params=params)['rows']
-    
+        if self.deviceList is None or datetime.now() - self.deviceListTime > DEVICE_LIST_TTL:
+            params={
+                'method':   'getList',
+                'typeList': '0',
+                'userId':   self.userId,
+            }
+            self.deviceList = self.get(self.base_url + DEVICE_LIST_PATH, params=params)['rows']
+            self.deviceListTime = datetime.now()
+        return self.deviceList
+
     def getFirstDeviceId(self) -> int:
         return self.getDeviceList()[0]['id']
 
-    def getDeviceData(self, deviceId: int, startDateTime: datetime, endDateTime: datetime):
+    def getDeviceData(self, deviceId: int, startDateTime: datetime, endDateTime: datetime, page: int = 1, rows: int = PAGE_SIZE):
         params = {
             'method'    : 'getList',
-            'page'      : '1',
-            'rows'      : '4500',
+            'page'      : str(page),
+            'rows'      : str(rows),
             'startDate' : startDateTime.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds'),
             'endDate'   : endDateTime.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds'),
             'deviceId'  : deviceId,
         }
-        return self.get('http://www.i-elitech.com//apiDeviceDataAction.do', params=params)['rows']
-    
+        return self.get(self.base_url + DEVICE_DATA_PATH, params=params)['rows']
+
+    def getAllDeviceData(self, deviceId: int, startDateTime: datetime, endDateTime: datetime, rows: int = PAGE_SIZE, beforePage=None):
+        """
+        Every row between `startDateTime` and `endDateTime`, requesting page after
+        page until one comes back short. `beforePage()` is called before each request.
+        """
+        data = []
+        previous = None
+        page = 1
+        while True:
+            if beforePage is not None:
+                beforePage()
+            pageData = self.getDeviceData(deviceId, startDateTime, endDateTime, page=page, rows=rows)
+            if pageData and pageData == previous:
+                raise RuntimeError(f'page {page} repeats the previous one, the API does not seem to page')
+            data += pageData
+            previous = pageData
+            if len(pageData) < rows:
+                return data
+            page += 1
+
+    def parseTimes(self, createTimes) -> List[int]:
+        """
+        Unix times of the `createTime`s (the device's local time), localizing only the
+        first reading of each hour rather than every reading.
+        """
+        hourStarts = {}
+        times = []
+        for createTime in createTimes:
+            hour = (createTime['year'], createTime['month'], createTime['date'], createTime['hours'])
+            hourStart = hourStarts.get(hour)
+            if hourStart is None:
+                d = datetime(
+                    day     = createTime['date'],
+                    hour    = createTime['hours'],
+                    month   = createTime['month']+1,
+                    year    = createTime['year']+1900,
+                    tzinfo  = None,
+                )
+                hourStart = hourStarts[hour] = int(self.timezone.localize(d).timestamp())
+            times.append(hourStart + createTime['minutes'] * 60 + createTime['seconds'])
+        return times
+
+    def parseM10iDeviceData(self, data) -> Dict[str, list]:
+        """The readings as columns: 'time' (unix seconds) and one per `readings`."""
+        return {
+            'time'  : self.parseTimes([d['createTime'] for d in data]),
+            'HCHO'  : [float(d['probe1']) for d in data],
+            'PM2.5' : [float(d['probe2']) for d in data],
+            'TVOC'  : [float(d['probe3']) for d in data],
+            'AQI'   : [float(d['probe4']) for d in data],
+        }
+
     def getM10iDeviceData(self, deviceId: int, startDateTime: datetime, endDateTime: datetime):
-        data = self.getDeviceData(deviceId, startDateTime, endDateTime)
-        
-        def parseDate(createTime) -> datetime:
-            d = datetime(
-                day     = createTime['date'],
-                hour    = createTime['hours'],
-                minute  = createTime['minutes'],
-                month   = createTime['month']+1,
-                second  = createTime['seconds'],
-                year    = createTime['year']+1900,
-                tzinfo  = None,
-            )
-            return self.timezone.localize(d)
-        return [
-            {
-                # 'originaldatetime': d['createTime'],
-                'datetime' : parseDate(d['createTime']),
-                'HCHO'     : float(d['probe1']),
-                'PM2.5'    : float(d['probe2']),
-                'TVOC'     : float(d['probe3']),
-                'AQI'      : float(d['probe4']),
-            }
-            for d in data
-        ]
+        return self.parseM10iDeviceData(self.getAllDeviceData(deviceId, startDateTime, endDateTime))
 
 
 if __name__ == '__main__':
@@ -105,10 +181,10 @@ if __name__ == '__main__':
         startDateTime=midnight,
         endDateTime=now,
     )
+    rows = [dict(zip(deviceData, row)) for row in zip(*deviceData.values())]
     print('data for today:')
-    for d in deviceData:
-        print(d)
+    for d in rows:
+        print({**d, 'time': datetime.fromtimestamp(d['time'], api.timezone)})
 
     for reading in [ 'HCHO', 'PM2.5', 'TVOC', 'AQI' ]:
-        print(f'min {reading}: {min(deviceData, key=lambda x: x[reading])}')
-
+        print(f'min {reading}: {min(rows, key=lambda x: x[reading])}')